@@ -0,0 +1,124 @@
+import logging
+import time
+import requests
+from qobuz_dl import qopy
+from qobuz_dl.exceptions import AuthenticationError, InvalidAppSecretError
+import qobuz as qobuz_cl
+from snapshot import load_json, save_json
+
+logger = logging.getLogger(__name__)
+
+def is_auth_error(e: Exception):
+    '''Tells whether an exception means that the cached tokens are no longer valid'''
+    if isinstance(e, requests.exceptions.HTTPError) and e.response is not None:
+        return e.response.status_code == 401
+    return isinstance(e, (AuthenticationError, InvalidAppSecretError))
+
+class CachedClient(qopy.Client):
+    '''
+    qobuz_dl API client restored from cached tokens, without logging in
+    '''
+    def __init__(self, app_id, secrets, sec, uat, label=None):
+        self.secrets = secrets
+        self.id = str(app_id)
+        self.session = requests.Session()
+        self.session.headers.update(
+            {
+                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:83.0) Gecko/20100101 Firefox/83.0",
+                "X-App-Id": self.id,
+                "X-User-Auth-Token": uat,
+            }
+        )
+        self.base = "https://www.qobuz.com/api.json/0.2/"
+        self.sec = sec
+        self.uat = uat
+        self.label = label
+
+def restore_user(username, cached: dict):
+    '''Returns a qobuz.User from cached login data, without logging in'''
+    user = qobuz_cl.User.__new__(qobuz_cl.User)
+    user.username = username
+    user.auth_token = cached["auth_token"]
+    user.id = cached["id"]
+    user.credential_id = cached.get("credential_id")
+    user.device_id = cached.get("device_id")
+    return user
+
+class SessionCache:
+    '''
+    App id, secrets and auth tokens of both API clients, persisted as JSON
+
+    Scraping the web player bundle and logging in only happen when there is
+    no cached session, when it is older than ttl seconds, or after the API
+    rejected the cached tokens.
+
+    Parameters
+    ----------
+    path: str
+        location of the session file
+    ttl: int
+        seconds after which the session is refreshed
+    '''
+    def __init__(self, path, ttl=604800):
+        self.path = path
+        self.ttl = ttl
+        self.client = None
+        self.user = None
+        self.created_at = None
+
+    def is_valid(self):
+        return self.created_at is not None and time.time() - self.created_at < self.ttl
+
+    def login(self, qobuz, email, password):
+        '''
+        Sets up qobuz.client and returns the qobuz.User, reusing the cached
+        session when it is still valid
+        '''
+        if not self.is_valid():
+            self._load(email)
+        if not self.is_valid():
+            logger.info("Logging in to Qobuz")
+            qobuz.get_tokens()
+            qobuz.initialize_client(email, password, qobuz.app_id, qobuz.secrets)
+            self.client = qobuz.client
+            self.user = qobuz_cl.User(email, password)
+            self.created_at = time.time()
+            self._save()
+        qobuz.app_id = self.client.id
+        qobuz.secrets = self.client.secrets
+        qobuz.client = self.client
+        return self.user
+
+    def invalidate(self):
+        logger.info("Discarding the cached Qobuz session")
+        self.client = None
+        self.user = None
+        self.created_at = None
+        save_json(self.path, dict())
+
+    def _load(self, email):
+        cached = load_json(self.path, dict())
+        if cached.get("email") != email or "client" not in cached:
+            return
+        self.client = CachedClient(**cached["client"])
+        self.user = restore_user(email, cached["user"])
+        self.created_at = cached["created_at"]
+
+    def _save(self):
+        save_json(self.path, {
+            "email": self.user.username,
+            "created_at": self.created_at,
+            "client": {
+                "app_id": self.client.id,
+                "secrets": self.client.secrets,
+                "sec": self.client.sec,
+                "uat": self.client.uat,
+                "label": self.client.label,
+            },
+            "user": {
+                "auth_token": self.user.auth_token,
+                "id": self.user.id,
+                "credential_id": self.user.credential_id,
+                "device_id": self.user.device_id,
+            },
+        })
@@ -0,0 +1,86 @@
+import time
+from threading import Lock
+
+def parse_schedule(schedule: str):
+    '''
+    Parses time-of-day bandwidth windows
+
+    Parameters
+    ----------
+    schedule: str
+        comma separated windows formatted as HH:MM-HH:MM=bytes per second,
+        e.g. 08:00-23:00=2000000. A window may wrap around midnight, 0 means
+        unlimited.
+
+    Returns a list of (start minute, end minute, rate) tuples
+    '''
+    windows = list()
+    for window in schedule.split(","):
+        window = window.strip()
+        if not window:
+            continue
+        hours, rate = window.split("=")
+        start, end = (_parse_minute(t) for t in hours.split("-"))
+        windows.append((start, end, int(rate)))
+    return windows
+
+def _parse_minute(value: str):
+    hours, minutes = value.strip().split(":")
+    return int(hours) * 60 + int(minutes)
+
+class BandwidthLimiter:
+    '''
+    Token bucket shared by every file download
+
+    Each chunk takes its size in tokens, the bucket being refilled at the
+    current rate and holding at most one second of it. Workers that run out
+    of tokens go into debt and sleep it off outside of the lock, so the
+    bandwidth left by idle workers goes to whichever worker is reading.
+
+    Parameters
+    ----------
+    rate: int
+        bytes per second, 0 for unlimited
+    windows: list
+        (start minute, end minute, rate) time-of-day windows overriding rate,
+        as returned by parse_schedule
+    '''
+    def __init__(self, rate=0, windows=None):
+        self.default_rate = rate
+        self.windows = windows or list()
+        self.lock = Lock()
+        self.tokens = 0
+        self.updated_at = time.monotonic()
+        self.rate = None
+        # the windows are only looked up again once per minute
+        self.rate_expires_at = 0
+
+    def current_rate(self):
+        local_time = time.localtime()
+        minute = local_time.tm_hour * 60 + local_time.tm_min
+        for start, end, rate in self.windows:
+            if start <= minute < end or (end < start and (minute >= start or minute < end)):
+                return rate
+        return self.default_rate
+
+    def consume(self, size):
+        '''Blocks until size bytes may be transferred'''
+        if not self.default_rate and not self.windows:
+            return
+        with self.lock:
+            now = time.monotonic()
+            if now >= self.rate_expires_at:
+                rate = self.current_rate()
+                if rate != self.rate:
+                    # start a new rate with a full bucket
+                    self.rate = rate
+                    self.tokens = rate
+                self.rate_expires_at = now + 60
+            if not self.rate:
+                return
+            self.tokens = min(self.rate, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= size
+            delay = -self.tokens / self.rate
+        if delay > 0:
+            time.sleep(delay)
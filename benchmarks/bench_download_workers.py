@@ -0,0 +1,68 @@
+'''
+Times the download of a backlog of favorite albums with 1, 4 and 8
+DOWNLOAD_WORKERS against a local stub CDN
+
+Every album is a few track files fetched one after the other, like
+ALBUM_TRACK_WORKERS=1, from a server adding latency to every request and
+capping the rate of each connection, the way a single CDN connection caps
+out well below the link speed.
+
+    python -m benchmarks.bench_download_workers
+'''
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from types import SimpleNamespace
+import requests
+from download import fetch_file
+from pipeline import FavoritesPipeline
+from tests.stub_server import serve
+
+def download_backlog(server, directory, workers, albums, tracks):
+    '''Returns the seconds taken to download every album with workers threads'''
+    session = requests.Session()
+
+    def download_album(album):
+        for track in range(tracks):
+            fetch_file(session, f"{server.url}/{album.id}/{track}.flac", os.path.join(directory, f"{album.id}-{track}.flac"))
+
+    pipeline = FavoritesPipeline(None, {"albums": download_album}, workers, None, remove_favorites=False)
+    started_at = time.monotonic()
+    pipeline.start()
+    for album_id in range(albums):
+        pipeline.submit("albums", SimpleNamespace(id=album_id))
+    pipeline.listing_finished()
+    pipeline.close()
+    elapsed = time.monotonic() - started_at
+    if pipeline.failure["albums"]:
+        raise RuntimeError(f"{len(pipeline.failure['albums'])} albums failed")
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--albums", type=int, default=16)
+    parser.add_argument("--tracks", type=int, default=4, help="tracks per album")
+    parser.add_argument("--track-size", type=int, default=1024 * 1024, help="bytes per track")
+    parser.add_argument("--rate", type=int, default=8 * 1024 * 1024, help="bytes per second of each connection")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds before every response")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8])
+    args = parser.parse_args()
+
+    server = serve(data=os.urandom(args.track_size), rate=args.rate, latency=args.latency)
+    total = args.albums * args.tracks * args.track_size
+    print(f"{args.albums} albums of {args.tracks} tracks, {total / 1024 ** 2:.0f} MB")
+    baseline = None
+    for workers in args.workers:
+        directory = tempfile.mkdtemp()
+        try:
+            elapsed = download_backlog(server, directory, workers, args.albums, args.tracks)
+        finally:
+            shutil.rmtree(directory)
+        baseline = baseline or elapsed
+        print(f"{workers} workers: {elapsed:.2f}s, {total / elapsed / 1024 ** 2:.1f} MB/s, x{baseline / elapsed:.1f}")
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
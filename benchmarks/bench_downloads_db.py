@@ -0,0 +1,70 @@
+'''
+Times the downloads database on one million downloaded ids: the migration
+of a qobuz_dl database, bulk downloaded() checks, and single contains()
+lookups and additions against the qobuz_dl helpers
+
+    python -m benchmarks.bench_downloads_db
+'''
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+from qobuz_dl.db import handle_download_id
+from downloads_db import DownloadsDB
+
+def create_legacy_db(path, rows):
+    '''Creates a qobuz_dl downloads database holding the ids 0 to rows - 1'''
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE downloads (id TEXT UNIQUE NOT NULL)")
+        conn.executemany("INSERT INTO downloads (id) VALUES (?)", ((str(item_id),) for item_id in range(rows)))
+    conn.close()
+
+def timed(name, function, count=None):
+    started_at = time.monotonic()
+    result = function()
+    elapsed = time.monotonic() - started_at
+    per_item = f", {elapsed / count * 1e6:.1f}us each" if count else ""
+    print(f"{name}: {elapsed * 1000:.0f}ms{per_item}")
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--bulk", type=int, default=10000, help="ids checked by downloaded()")
+    parser.add_argument("--single", type=int, default=2000, help="ids looked up and added one at a time")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        legacy_path = os.path.join(directory, "legacy.db")
+        path = os.path.join(directory, "db")
+        timed(f"create a qobuz_dl database of {args.rows} ids", lambda: create_legacy_db(legacy_path, args.rows))
+        shutil.copyfile(legacy_path, path)
+        db = timed("migrate it", lambda: DownloadsDB(path))
+
+        # half of the ids are downloaded
+        ids = [random.randrange(2 * args.rows) for _ in range(max(args.bulk, args.single))]
+        found = timed(f"downloaded() of {args.bulk} ids", lambda: db.downloaded(ids[:args.bulk]), args.bulk)
+        print(f"  {len(found)} of them downloaded")
+        timed(f"contains() of {args.single} ids", lambda: [db.contains(item_id) for item_id in ids[:args.single]], args.single)
+        timed(
+            f"qobuz_dl lookup of {args.single} ids",
+            lambda: [handle_download_id(legacy_path, str(item_id)) for item_id in ids[:args.single]],
+            args.single,
+        )
+
+        new_ids = range(2 * args.rows, 2 * args.rows + args.single)
+        timed(f"add() of {args.single} ids, then flush()", lambda: ([db.add(item_id) for item_id in new_ids], db.flush()), args.single)
+        timed(
+            f"qobuz_dl addition of {args.single} ids",
+            lambda: [handle_download_id(legacy_path, str(item_id), add_id=True) for item_id in new_ids],
+            args.single,
+        )
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+'''
+Times the listing of the favorites by iter_user_favorites, paging serially
+against prefetching the pages concurrently, on a stub
+favorite/getUserFavorites endpoint
+
+The stub answers every page after a fixed latency plus a cost per item,
+like the Qobuz API, and caps the page size at 500.
+
+    python -m benchmarks.bench_favorites_paging
+'''
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from http.server import BaseHTTPRequestHandler
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+from tests.stub_server import serve
+
+class FavoritesHandler(BaseHTTPRequestHandler):
+    '''Serves pages of the server favorites, in the Qobuz API format'''
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        if not url.path.endswith("/favorite/getUserFavorites"):
+            self.send_error(404)
+            return
+        params = {name: values[0] for name, values in parse_qs(url.query).items()}
+        server.requests.append(params)
+        fav_type = params["type"]
+        limit = min(int(params.get("limit", 50)), 500)
+        offset = int(params.get("offset", 0))
+        items = server.favorites[offset:offset + limit]
+        time.sleep(server.latency + server.item_cost * len(items))
+        body = json.dumps({fav_type: {"offset": offset, "limit": limit, "total": len(server.favorites), "items": items}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def import_main():
+    '''Imports main with a throwaway configuration, without its scheduler'''
+    directory = tempfile.mkdtemp()
+    os.environ.update(
+        QOBUZ_EMAIL="benchmark",
+        QOBUZ_PASSWORD="benchmark",
+        QOBUZ_APP_ID="0",
+        MUSIC_DIRECTORY=os.path.join(directory, "music"),
+        CONFIG_DIRECTORY=directory,
+        LIBRARY_INDEX="false",
+        TRIGGER_PORT="0",
+    )
+    import main as app
+    app.stop_run_continuously.set()
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--favorites", type=int, default=5000)
+    parser.add_argument("--latency", type=float, default=0.15, help="seconds of every request")
+    parser.add_argument("--item-cost", type=float, default=0.0002, help="seconds per favorite in a page")
+    parser.add_argument("--workers", type=int, default=4, help="pages prefetched at the same time")
+    args = parser.parse_args()
+
+    app = import_main()
+    favorites = [
+        {"id": str(album_id), "title": f"Album {album_id}", "artist": {"id": 1, "name": "Artist"}}
+        for album_id in range(args.favorites)
+    ]
+    server = serve(FavoritesHandler, favorites=favorites, latency=args.latency, item_cost=args.item_cost)
+    app.qobuz_api.API_URL = f"{server.url}/api.json/0.2/"
+    user = SimpleNamespace(auth_token="benchmark")
+
+    print(f"{args.favorites} album favorites, {args.latency * 1000:.0f}ms per request")
+    baseline = None
+    for name, limit, workers in (
+        ("serial, 50 per page", 50, 1),
+        ("serial, 500 per page", 500, 1),
+        (f"prefetch, 500 per page, {args.workers} workers", 500, args.workers),
+        (f"prefetch, 100 per page, {args.workers} workers", 100, args.workers),
+    ):
+        requests_sent = len(server.requests)
+        started_at = time.monotonic()
+        listed = sum(1 for _ in app.iter_user_favorites(user, "albums", limit=limit, workers=workers))
+        elapsed = time.monotonic() - started_at
+        if listed != args.favorites:
+            sys.exit(f"{name}: listed {listed} of {args.favorites} favorites")
+        baseline = baseline or elapsed
+        print(f"{name}: {elapsed:.2f}s, {len(server.requests) - requests_sent} requests, x{baseline / elapsed:.1f}")
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+'''
+Times LibraryIndex.update on a generated tree of tagged FLAC files: the cold
+build of the index, rescans of an unchanged tree with and without a full
+listing, and an incremental rescan after an album is added and another one
+removed. A walk of the tree with a stat of every file is timed for
+comparison.
+
+    python -m benchmarks.bench_library_scan
+'''
+import argparse
+import os
+import shutil
+import struct
+import tempfile
+import time
+from mutagen.flac import FLAC
+from library import LibraryIndex
+
+def flac_template(path):
+    '''Writes a tagged FLAC file holding only its metadata, and returns its bytes'''
+    # STREAMINFO: 4096 samples blocks, 44.1 kHz, stereo, 16 bits, no samples
+    fields = (44100 << 44) | (1 << 41) | (15 << 36)
+    streaminfo = struct.pack(">HH", 4096, 4096) + bytes(6) + fields.to_bytes(8, "big") + bytes(16)
+    with open(path, "wb") as file:
+        file.write(b"fLaC" + bytes([0x80]) + len(streaminfo).to_bytes(3, "big") + streaminfo)
+    audio = FLAC(path)
+    audio.add_tags()
+    audio.update({
+        "TITLE": "Track",
+        "ARTIST": "Artist",
+        "ALBUM": "Album",
+        "ISRC": "FRZ000000000",
+        "BARCODE": "0000000000000",
+        "QOBUZ_TRACK_ID": "1",
+        "QOBUZ_ALBUM_ID": "album",
+    })
+    audio.save(padding=lambda info: 0)
+    with open(path, "rb") as file:
+        return file.read()
+
+def write_album(directory, template, tracks):
+    os.makedirs(directory)
+    for track in range(tracks):
+        with open(os.path.join(directory, f"{track + 1:02d} - Track.flac"), "wb") as file:
+            file.write(template)
+
+def generate_tree(root, files, tracks, artists):
+    '''Writes files FLAC files, tracks per album directory, under artists directories'''
+    template = flac_template(os.path.join(root, "template.flac"))
+    os.remove(os.path.join(root, "template.flac"))
+    albums = -(-files // tracks)
+    for album in range(albums):
+        write_album(os.path.join(root, f"Artist {album % artists}", f"Album {album}"), template, tracks)
+    return template
+
+def timed(name, function):
+    started_at = time.monotonic()
+    result = function()
+    print(f"{name}: {time.monotonic() - started_at:.2f}s, {result}")
+
+def walk(root):
+    count = 0
+    for directory, _, names in os.walk(root):
+        for name in names:
+            os.stat(os.path.join(directory, name))
+            count += 1
+    return f"{count} files"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--files", type=int, default=100000)
+    parser.add_argument("--tracks", type=int, default=10, help="files per album directory")
+    parser.add_argument("--artists", type=int, default=1000, help="artist directories holding the albums")
+    parser.add_argument("--workers", type=int, default=8, help="threads reading the tags")
+    parser.add_argument("--directory", help="where the tree is generated, a temporary directory by default")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(dir=args.directory)
+    try:
+        root = os.path.join(directory, "music")
+        os.makedirs(root)
+        started_at = time.monotonic()
+        template = generate_tree(root, args.files, args.tracks, args.artists)
+        print(f"Generated {args.files} files in {time.monotonic() - started_at:.1f}s")
+
+        path = os.path.join(directory, "library.db")
+        index = LibraryIndex(path, workers=args.workers)
+        # updates return the number of files read and removed
+        timed("cold build", lambda: index.update(root))
+        timed("unchanged, incremental", lambda: index.update(root))
+        full_index = LibraryIndex(path, full_scan_interval=0, workers=args.workers)
+        timed("unchanged, full listing", lambda: full_index.update(root))
+
+        write_album(os.path.join(root, "Artist 0", "New album"), template, args.tracks)
+        shutil.rmtree(os.path.join(root, "Artist 1", "Album 1"))
+        timed("one album added and one removed", lambda: index.update(root))
+        timed("os.walk and stat", lambda: walk(root))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+'''
+Times the download of one large track file with DOWNLOAD_SEGMENTS 1 against
+N, from a local stub CDN capping the rate of each connection
+
+    python -m benchmarks.bench_segments
+'''
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import requests
+import download
+from tests.stub_server import serve
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=64 * 1024 * 1024, help="bytes of the file")
+    parser.add_argument("--rate", type=int, default=16 * 1024 * 1024, help="bytes per second of each connection")
+    parser.add_argument("--segment-size", type=int, default=8 * 1024 * 1024, help="smallest segment, 32 MB in the app")
+    parser.add_argument("--segments", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    # smaller segments than the app, so that a short file is split as much as a long one
+    download.segment_size = args.segment_size
+    data = os.urandom(args.size)
+    server = serve(data=data, rate=args.rate)
+    session = requests.Session()
+    print(f"{args.size / 1024 ** 2:.0f} MB at {args.rate / 1024 ** 2:.0f} MB/s per connection")
+    baseline = None
+    for segments in args.segments:
+        directory = tempfile.mkdtemp()
+        fname = os.path.join(directory, "track.flac")
+        try:
+            started_at = time.monotonic()
+            download.fetch_file(session, f"{server.url}/track.flac", fname, max_segments=segments)
+            elapsed = time.monotonic() - started_at
+            with open(fname, "rb") as file:
+                if file.read() != data:
+                    sys.exit(f"{segments} segments: the downloaded file differs")
+        finally:
+            shutil.rmtree(directory)
+        baseline = baseline or elapsed
+        print(f"{segments} segments: {elapsed:.2f}s, {args.size / elapsed / 1024 ** 2:.1f} MB/s, x{baseline / elapsed:.1f}")
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
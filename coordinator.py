@@ -0,0 +1,101 @@
+import logging
+import time
+from threading import Lock, Thread
+from snapshot import load_json, save_json
+
+logger = logging.getLogger(__name__)
+
+class RunCoordinator:
+    '''
+    Makes sure a single run is in progress at a time, and persists the state
+    of the runs as JSON
+
+    A run is started in a background thread by trigger. Triggering while a
+    run is in progress refreshes that run instead, handing its live pipeline
+    to the refresh function so that favorites added in the meantime join
+    the current run instead of waiting for the next one.
+
+    Parameters
+    ----------
+    path: str
+        location of the run state file
+    run: function
+        called without arguments to do a run
+    refresh: function
+        called with the pipeline of the run in progress
+    '''
+    def __init__(self, path, run, refresh):
+        self.path = path
+        self.run_function = run
+        self.refresh_function = refresh
+        # held for the whole duration of a run
+        self.lock = Lock()
+        # guards the pipeline, so that it is never refreshed once it closes
+        self.pipeline_lock = Lock()
+        self.pipeline = None
+        self.thread = None
+        self.state = load_json(path, dict())
+        if self.state.get("running"):
+            logger.warning(f"The run started at {time.ctime(self.state['started_at'])} was interrupted")
+            self._save(running=False, error="interrupted")
+
+    def is_running(self):
+        return self.lock.locked()
+
+    def last_finished_at(self):
+        return self.state.get("finished_at") or 0
+
+    def trigger(self, reason):
+        '''
+        Starts a run in the background, or refreshes the run in progress.
+        Returns True when a new run was started.
+        '''
+        if not self.lock.acquire(blocking=False):
+            self.refresh()
+            return False
+        try:
+            self.thread = Thread(target=self._run, args=(reason,), daemon=True)
+            self.thread.start()
+        except Exception:
+            self.lock.release()
+            raise
+        return True
+
+    def attach(self, pipeline):
+        '''Exposes the pipeline of the run in progress to the refreshes'''
+        with self.pipeline_lock:
+            self.pipeline = pipeline
+
+    def detach(self):
+        '''Waits for a refresh in progress, to be called before the pipeline closes'''
+        with self.pipeline_lock:
+            self.pipeline = None
+
+    def refresh(self):
+        with self.pipeline_lock:
+            if self.pipeline is None:
+                return
+            try:
+                self.refresh_function(self.pipeline)
+            except Exception as e:
+                print(f"An error occurred adding favorites to the current run: {e}")
+
+    def _run(self, reason):
+        try:
+            self._save(running=True, reason=reason, started_at=time.time(), error=None)
+            print(f"Job started ({reason})!")
+            error = None
+            try:
+                self.run_function()
+            except Exception as e:
+                error = str(e)
+                print(f"An error occurred: {e}")
+            self._save(running=False, finished_at=time.time(), error=error)
+            print("Job finished!")
+        finally:
+            self.detach()
+            self.lock.release()
+
+    def _save(self, **state):
+        self.state.update(state)
+        save_json(self.path, self.state)
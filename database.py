@@ -0,0 +1,60 @@
+import sqlite3
+from abc import ABC, abstractmethod
+from threading import local
+
+# largest number of ids bound to a single query
+query_batch_size = 500
+
+def batches(item_ids):
+    '''Yields the distinct ids as strings, in lists small enough for a single query'''
+    item_ids = list(dict.fromkeys(str(item_id) for item_id in item_ids))
+    for start in range(0, len(item_ids), query_batch_size):
+        yield item_ids[start:start + query_batch_size]
+
+def placeholders(batch):
+    '''Returns the parameters of an IN clause matching batch'''
+    return ",".join("?" * len(batch))
+
+class Database(ABC):
+    '''
+    SQLite database in WAL mode with one connection per thread, so that
+    reads never wait for a write
+
+    The version of the schema is stored in the user_version of the database.
+    Subclasses set schema_version and create or migrate their tables in
+    _upgrade, which runs in a single transaction when the database is older.
+
+    Parameters
+    ----------
+    path: str
+        location of the database file
+    '''
+    schema_version = 0
+
+    def __init__(self, path):
+        self.path = path
+        self.connections = local()
+        self._migrate()
+
+    def _connection(self):
+        conn = getattr(self.connections, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.connections.conn = conn
+        return conn
+
+    def _migrate(self):
+        conn = self._connection()
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= self.schema_version:
+            return
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._upgrade(conn, version)
+            conn.execute(f"PRAGMA user_version={self.schema_version}")
+
+    @abstractmethod
+    def _upgrade(self, conn: sqlite3.Connection, version):
+        '''Brings the schema from version to schema_version'''
@@ -0,0 +1,647 @@
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import requests
+from pathvalidate import sanitize_filename, sanitize_filepath
+from qobuz_dl import downloader, metadata
+from qobuz_dl.core import QobuzDL
+from qobuz_dl.exceptions import NonStreamable
+from qobuz_dl.utils import smart_discography_filter
+from bandwidth import BandwidthLimiter
+from http_pool import ConnectionPool
+from library import LibraryIndex, get_track_ids, write_ids
+from snapshot import load_json, save_json
+
+logger = logging.getLogger(__name__)
+
+chunk_size = 64 * 1024
+# partial downloads record their offset every checkpoint_size bytes
+checkpoint_size = 4 * 1024 * 1024
+# files are split in segments of at least segment_size bytes
+segment_size = 32 * 1024 * 1024
+# bytes fetched by dry runs to measure the throughput
+sample_size = 8 * 1024 * 1024
+
+class IncompleteDownload(Exception):
+    pass
+
+class TransferStats:
+    '''
+    Bytes fetched by fetch_file, used to measure the throughput of the runs
+    '''
+    def __init__(self):
+        self.lock = Lock()
+        self.bytes = 0
+
+    def add(self, size):
+        with self.lock:
+            self.bytes += size
+
+transfer_stats = TransferStats()
+
+# covers and booklets are shared by the tracks of an album, only one download
+# fetches each of them at a time
+extra_locks = [Lock() for _ in range(64)]
+
+class DownloadEstimate:
+    '''
+    Number of files and bytes a run would download, with the URL of one of
+    the files to measure the throughput
+    '''
+    def __init__(self):
+        self.lock = Lock()
+        self.files = 0
+        self.bytes = 0
+        self.sample_url = None
+
+    def add(self, files, size, sample_url=None):
+        with self.lock:
+            self.files += files
+            self.bytes += size
+            self.sample_url = self.sample_url or sample_url
+
+def measure_throughput(session: requests.Session, url, size=sample_size, limiter: BandwidthLimiter = None):
+    '''
+    Returns the bytes per second of a download of the first size bytes of
+    url, or None when it fails. Nothing is written to disk.
+    '''
+    received = 0
+    started_at = time.monotonic()
+    try:
+        with session.get(url, headers={"Range": f"bytes=0-{size - 1}"}, allow_redirects=True, stream=True) as r:
+            if not r.ok:
+                return None
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                if limiter is not None:
+                    limiter.consume(len(chunk))
+                received += len(chunk)
+                if received >= size:
+                    break
+    except requests.RequestException as e:
+        logger.info(f"Could not measure the throughput: {e}")
+        return None
+    elapsed = time.monotonic() - started_at
+    if not received or elapsed <= 0:
+        return None
+    return received / elapsed
+
+class RestartDownload(Exception):
+    pass
+
+def _fetch_part(session: requests.Session, url, part, record_path, record: dict, limiter: BandwidthLimiter = None):
+    '''
+    Fetches the missing bytes of a partial file, saving the reached offset in
+    the record every checkpoint_size bytes and when the transfer breaks
+    '''
+    offset = record.get("offset", 0)
+    headers = dict()
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+        if record.get("etag"):
+            # a changed file is sent whole instead of the requested range
+            headers["If-Range"] = record["etag"]
+    with session.get(url, headers=headers, allow_redirects=True, stream=True) as r:
+        if r.status_code == 416:
+            raise RestartDownload(f"range {offset}- not satisfiable")
+        r.raise_for_status()
+        if r.status_code == 206:
+            # e.g. "bytes 1000-4999/5000"
+            content_range = r.headers.get("content-range", "")
+            start, _, total = content_range.replace("bytes ", "").replace("-", "/").split("/")
+            if int(start) != offset or int(total) != record.get("total"):
+                raise RestartDownload(f"unexpected content range {content_range}")
+        else:
+            offset = 0
+            record.clear()
+            record.update(offset=0, total=int(r.headers.get("content-length", 0)), etag=r.headers.get("etag"))
+            save_json(record_path, record)
+        with open(part, "r+b" if offset else "wb") as file:
+            file.seek(offset)
+            file.truncate()
+            try:
+                for data in r.iter_content(chunk_size=chunk_size):
+                    offset += file.write(data)
+                    transfer_stats.add(len(data))
+                    if limiter is not None:
+                        limiter.consume(len(data))
+                    if offset - record["offset"] >= checkpoint_size:
+                        file.flush()
+                        os.fsync(file.fileno())
+                        record["offset"] = offset
+                        save_json(record_path, record)
+            finally:
+                file.flush()
+                record["offset"] = offset
+                save_json(record_path, record)
+    if record["total"] and offset != record["total"]:
+        raise ConnectionError(f"File download was interrupted at {offset} of {record['total']} bytes for {part}")
+
+def _clone_session(session: requests.Session):
+    '''Returns a new session sharing the headers and connection pool of session'''
+    clone = requests.Session()
+    clone.headers.update(session.headers)
+    for prefix, adapter in session.adapters.items():
+        clone.mount(prefix, adapter)
+    return clone
+
+def _start_segments(session: requests.Session, url, part, record_path, max_segments):
+    '''
+    Splits the file at url into segments according to its size, and
+    preallocates the partial file they are written into. Returns the record
+    of the segments, or an empty one when the file is not worth splitting
+    or its size can't be known, so that it is fetched in a single stream.
+    '''
+    r = session.head(url, allow_redirects=True)
+    if not r.ok:
+        # some CDNs reject HEAD requests, segments are only a speed-up
+        logger.info(f"Not splitting {part} in segments: HEAD returned HTTP {r.status_code}")
+        return dict()
+    total = int(r.headers.get("content-length", 0))
+    if r.headers.get("accept-ranges") != "bytes" or total < 2 * segment_size:
+        return dict()
+    count = min(max_segments, total // segment_size)
+    size = -(-total // count)
+    record = {
+        "total": total,
+        "etag": r.headers.get("etag"),
+        "segments": [
+            {"start": start, "end": min(start + size, total) - 1, "offset": start}
+            for start in range(0, total, size)
+        ],
+    }
+    with open(part, "wb") as file:
+        try:
+            os.posix_fallocate(file.fileno(), 0, total)
+        except (AttributeError, OSError):
+            # not available on every platform and file system, e.g. musl or
+            # NFS, a sparse file works just as well
+            file.truncate(total)
+    save_json(record_path, record)
+    return record
+
+def _fetch_segment(session: requests.Session, url, part, record_path, record: dict, segment: dict, lock: Lock,
+                   limiter: BandwidthLimiter = None):
+    '''
+    Fetches the missing bytes of one segment straight into its place in the
+    preallocated partial file
+    '''
+    offset = segment["offset"]
+    if offset > segment["end"]:
+        return
+    headers = {"Range": f"bytes={offset}-{segment['end']}"}
+    if record.get("etag"):
+        headers["If-Range"] = record["etag"]
+    with session.get(url, headers=headers, allow_redirects=True, stream=True) as r:
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise RestartDownload("the server sent the whole file instead of a segment")
+        with open(part, "r+b") as file:
+            file.seek(offset)
+            checkpoint = offset
+            try:
+                for data in r.iter_content(chunk_size=chunk_size):
+                    # never write into the next segment
+                    data = data[:segment["end"] + 1 - offset]
+                    offset += file.write(data)
+                    transfer_stats.add(len(data))
+                    if limiter is not None:
+                        limiter.consume(len(data))
+                    if offset - checkpoint >= checkpoint_size:
+                        file.flush()
+                        os.fsync(file.fileno())
+                        checkpoint = offset
+                        with lock:
+                            segment["offset"] = offset
+                            save_json(record_path, record)
+            finally:
+                file.flush()
+                os.fsync(file.fileno())
+                with lock:
+                    segment["offset"] = offset
+                    save_json(record_path, record)
+    if offset != segment["end"] + 1:
+        raise ConnectionError(f"Segment download was interrupted at {offset} of {segment['end'] + 1} bytes for {part}")
+
+def _fetch_segments(session: requests.Session, url, part, record_path, record: dict, limiter: BandwidthLimiter = None):
+    lock = Lock()
+    with ThreadPoolExecutor(max_workers=len(record["segments"])) as executor:
+        futures = [
+            executor.submit(_fetch_segment, _clone_session(session), url, part, record_path, record, segment, lock, limiter)
+            for segment in record["segments"]
+        ]
+        for future in futures:
+            future.result()
+
+def fetch_file(session: requests.Session, url, fname, retries=3, max_segments=1, limiter: BandwidthLimiter = None):
+    '''
+    Downloads url to fname, resuming a previously interrupted download
+
+    Bytes are written to fname.part, with the expected size, ETag and reached
+    offset recorded in fname.part.json. A broken transfer is resumed with a
+    Range request, right away up to retries times, or by the next run since
+    the partial file and its record are kept. fname only appears once the
+    download is complete.
+
+    With max_segments above 1, large files are fetched as that many parallel
+    Range requests at most, one per segment_size bytes, each written in
+    place into the preallocated partial file.
+
+    Every chunk read goes through the limiter, if any, shared by all
+    downloads to cap their total bandwidth.
+    '''
+    part = f"{fname}.part"
+    record_path = f"{part}.json"
+    record = load_json(record_path, dict()) if os.path.isfile(part) else dict()
+    if not record.get("segments"):
+        # never trust bytes that were written after the last recorded offset
+        record["offset"] = min(record.get("offset", 0), os.path.getsize(part) if os.path.isfile(part) else 0)
+        if max_segments > 1 and not record["offset"]:
+            record = _start_segments(session, url, part, record_path, max_segments) or record
+    for attempt in range(retries + 1):
+        try:
+            if record.get("segments"):
+                _fetch_segments(session, url, part, record_path, record, limiter)
+            else:
+                _fetch_part(session, url, part, record_path, record, limiter)
+            break
+        except RestartDownload as e:
+            logger.info(f"Restarting the download of {fname}: {e}")
+            record = {"offset": 0}
+        except (ConnectionError, requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+            if attempt == retries:
+                raise
+            logger.info(f"Resuming the download of {fname}: {e}")
+    else:
+        raise ConnectionError(f"Could not download {fname}")
+    os.replace(part, fname)
+    os.remove(record_path)
+
+class ParallelDownload(downloader.Download):
+    '''
+    qobuz_dl Download that fetches the tracks of a release concurrently
+
+    Folder layout, file names and tags are the same as the ones produced by
+    qobuz_dl, only the track loop of download_release runs on a pool. Files
+    are fetched through the shared connection pool, large track files in up
+    to max_segments parallel segments, and within the bandwidth of the
+    limiter. Releases and tracks already in the library index are skipped,
+    and downloaded files are tagged with their ISRC, UPC and Qobuz ids.
+    '''
+    def __init__(self, *args, track_workers=4, pool: ConnectionPool = None, max_segments=1,
+                 limiter: BandwidthLimiter = None, library: LibraryIndex = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.track_workers = track_workers
+        self.pool = pool or ConnectionPool()
+        self.max_segments = max_segments
+        self.limiter = limiter
+        self.library = library
+        # the API client session is shared by the track workers
+        self.client_lock = Lock()
+
+    def _get_release_meta(self):
+        '''
+        Returns the album metadata and format, or None for the releases
+        that qobuz_dl would skip
+        '''
+        meta = self.client.get_album_meta(self.item_id)
+
+        if not meta.get("streamable"):
+            raise NonStreamable("This release is not streamable")
+
+        if self.albums_only and (
+            meta.get("release_type") != "album"
+            or meta.get("artist").get("name") == "Various Artists"
+        ):
+            logger.info(f'Ignoring Single/EP/VA: {meta.get("title", "n/a")}')
+            return None
+
+        format_info = self._get_format(meta)
+        if not self.downgrade_quality and not format_info[1]:
+            logger.info(f"Skipping {downloader._get_title(meta)} as it doesn't meet quality requirement")
+            return None
+
+        if self.library is not None and self.library.album_files(meta["id"], meta.get("upc")) >= meta["tracks_count"]:
+            logger.info(f"{downloader._get_title(meta)} is already in the library")
+            return None
+        return meta, format_info
+
+    def _get_track_size(self, track_url_dict):
+        '''
+        Returns the size of a track file, without downloading it
+        '''
+        r = self.pool.session().head(track_url_dict["url"], allow_redirects=True)
+        # the length of an error page is not the one of the file
+        size = int(r.headers.get("content-length", 0)) if r.ok else 0
+        if size:
+            return size
+        # no size from the CDN, estimate it from the duration and the format
+        duration = track_url_dict.get("duration") or 0
+        if int(self.quality) == 5:
+            return duration * 320000 // 8
+        # FLAC compresses stereo PCM to roughly 60% of its size
+        bit_depth = track_url_dict.get("bit_depth") or 16
+        sampling_rate = track_url_dict.get("sampling_rate") or 44.1
+        return int(duration * bit_depth * sampling_rate * 1000 * 2 / 8 * 0.6)
+
+    def estimate_release(self):
+        '''
+        Returns the number of files and bytes download_release would fetch,
+        and the URL of one of the files
+        '''
+        release = self._get_release_meta()
+        if release is None:
+            return 0, 0, None
+        meta, _ = release
+
+        def estimate_track(track):
+            with self.client_lock:
+                parse = self.client.get_track_url(track["id"], fmt_id=self.quality)
+            if "sample" in parse or not parse["sampling_rate"] or "url" not in parse:
+                return 0, None
+            return self._get_track_size(parse), parse["url"]
+
+        with ThreadPoolExecutor(max_workers=self.track_workers) as executor:
+            tracks = [(size, url) for size, url in executor.map(estimate_track, meta["tracks"]["items"]) if size]
+        if not tracks:
+            return 0, 0, None
+        return len(tracks), sum(size for size, _ in tracks), tracks[0][1]
+
+    def estimate_track(self):
+        '''
+        Returns the number of files and bytes download_track would fetch,
+        and the URL of the file
+        '''
+        parse = self.client.get_track_url(self.item_id, self.quality)
+        if "sample" in parse or not parse["sampling_rate"] or "url" not in parse:
+            return 0, 0, None
+        _, quality_met, _, _ = self._get_format(dict(), is_track_id=True, track_url_dict=parse)
+        if not self.downgrade_quality and not quality_met:
+            return 0, 0, None
+        return 1, self._get_track_size(parse), parse["url"]
+
+    def download_release(self):
+        release = self._get_release_meta()
+        if release is None:
+            return
+        meta, (file_format, quality_met, bit_depth, sampling_rate) = release
+        album_title = downloader._get_title(meta)
+
+        logger.info(f"Downloading: {album_title}\nQuality: {file_format} ({bit_depth}/{sampling_rate})")
+        album_attr = self._get_album_attr(meta, album_title, file_format, bit_depth, sampling_rate)
+        folder_format, track_format = downloader._clean_format_str(
+            self.folder_format, self.track_format, file_format
+        )
+        dirn = os.path.join(self.path, sanitize_filepath(folder_format.format(**album_attr)))
+        os.makedirs(dirn, exist_ok=True)
+
+        if not self.no_cover:
+            self._get_extra(meta["image"]["large"], dirn, og_quality=self.cover_og_quality)
+
+        if "goodies" in meta:
+            try:
+                self._get_extra(meta["goodies"][0]["url"], dirn, "booklet.pdf")
+            except Exception:
+                pass
+
+        tracks = meta["tracks"]["items"]
+        is_multiple = len({track["media_number"] for track in tracks}) > 1
+        is_mp3 = int(self.quality) == 5
+
+        def download_track(count, track):
+            with self.client_lock:
+                parse = self.client.get_track_url(track["id"], fmt_id=self.quality)
+            if "sample" in parse or not parse["sampling_rate"]:
+                logger.info("Demo. Skipping")
+                return None
+            return self._download_and_tag(
+                dirn,
+                count,
+                parse,
+                track,
+                meta,
+                False,
+                is_mp3,
+                track["media_number"] if is_multiple else None,
+            )
+
+        with ThreadPoolExecutor(max_workers=self.track_workers) as executor:
+            futures = [executor.submit(download_track, count, track) for count, track in enumerate(tracks)]
+            # wait for every track, then surface the first error
+            final_files = [future.exception() or future.result() for future in futures]
+
+        errors = [result for result in final_files if isinstance(result, Exception)]
+        if errors:
+            raise IncompleteDownload(f"{len(errors)} of {len(tracks)} tracks failed: {errors[0]}") from errors[0]
+
+        # verify that every downloaded track landed under its final name
+        missing = [path for path in final_files if path and not os.path.isfile(path)]
+        if missing:
+            raise IncompleteDownload(f"{len(missing)} of {len(tracks)} tracks are missing, e.g. {missing[0]}")
+        logger.info("Completed")
+
+    def download_track(self):
+        '''
+        Same as qobuz_dl's download_track, but fetches the cover and the file
+        through the connection pool, and raises when the file is missing
+        '''
+        parse = self.client.get_track_url(self.item_id, self.quality)
+        if "sample" in parse or not parse["sampling_rate"]:
+            logger.info("Demo. Skipping")
+            return
+        meta = self.client.get_track_meta(self.item_id)
+        track_title = downloader._get_title(meta)
+        file_format, quality_met, bit_depth, sampling_rate = self._get_format(
+            meta, is_track_id=True, track_url_dict=parse
+        )
+        if not self.downgrade_quality and not quality_met:
+            logger.info(f"Skipping {track_title} as it doesn't meet quality requirement")
+            return
+
+        logger.info(f"Downloading: {track_title}\nQuality: {file_format} ({bit_depth}/{sampling_rate})")
+        track_attr = self._get_track_attr(meta, track_title, bit_depth, sampling_rate)
+        folder_format, _ = downloader._clean_format_str(self.folder_format, self.track_format, str(bit_depth))
+        dirn = os.path.join(self.path, sanitize_filepath(folder_format.format(**track_attr)))
+        os.makedirs(dirn, exist_ok=True)
+
+        if not self.no_cover:
+            self._get_extra(meta["album"]["image"]["large"], dirn, og_quality=self.cover_og_quality)
+
+        final_file = self._download_and_tag(dirn, 1, parse, meta, meta, True, int(self.quality) == 5)
+        if final_file and not os.path.isfile(final_file):
+            raise IncompleteDownload(f"The track is missing, expected {final_file}")
+        logger.info("Completed")
+
+    def _download_and_tag(
+        self,
+        root_dir,
+        tmp_count,
+        track_url_dict,
+        track_metadata,
+        album_or_track_metadata,
+        is_track,
+        is_mp3,
+        multiple=None,
+    ):
+        '''
+        Same as qobuz_dl's _download_and_tag, but returns the final file path
+        and raises when tagging fails instead of leaving the temp file behind
+        '''
+        extension = ".mp3" if is_mp3 else ".flac"
+
+        try:
+            url = track_url_dict["url"]
+        except KeyError:
+            logger.info("Track not available for download")
+            return None
+
+        if multiple:
+            root_dir = os.path.join(root_dir, f"Disc {multiple}")
+            os.makedirs(root_dir, exist_ok=True)
+
+        # named after the track, so that concurrent downloads never share a
+        # temp file and an interrupted one is found again by the next run
+        filename = os.path.join(root_dir, f".{track_metadata['id']}.tmp")
+
+        track_title = track_metadata.get("title")
+        artist = downloader._safe_get(track_metadata, "performer", "name")
+        filename_attr = self._get_filename_attr(artist, track_metadata, track_title)
+        formatted_path = sanitize_filename(self.track_format.format(**filename_attr))
+        final_file = os.path.join(root_dir, formatted_path)[:250] + extension
+
+        if os.path.isfile(final_file):
+            logger.info(f"{track_title} was already downloaded")
+            return final_file
+
+        # single tracks carry their album metadata
+        album_metadata = track_metadata["album"] if is_track else album_or_track_metadata
+        ids = get_track_ids(track_metadata, album_metadata)
+        if self.library is not None:
+            library_file = self.library.find_track(ids["track_id"], ids["isrc"])
+            if library_file is not None:
+                logger.info(f"{track_title} is already in the library as {library_file}")
+                return library_file
+
+        fetch_file(self.pool.session(), url, filename, max_segments=self.max_segments, limiter=self.limiter)
+        # qobuz_dl keeps the tags already in the file
+        write_ids(filename, ids, is_mp3)
+        tag_function = metadata.tag_mp3 if is_mp3 else metadata.tag_flac
+        tag_function(
+            filename,
+            root_dir,
+            final_file,
+            track_metadata,
+            album_or_track_metadata,
+            is_track,
+            self.embed_art,
+        )
+        if self.library is not None:
+            self.library.add(final_file, ids)
+        return final_file
+
+    def _get_extra(self, url, dirn, extra="cover.jpg", og_quality=False):
+        extra_file = os.path.join(dirn, extra)
+        with extra_locks[hash(os.path.abspath(extra_file)) % len(extra_locks)]:
+            # fetched by another download of the same album in the meantime
+            if os.path.isfile(extra_file):
+                return
+            fetch_file(
+                self.pool.session(),
+                url.replace("_600.", "_org.") if og_quality else url,
+                extra_file,
+                limiter=self.limiter,
+            )
+
+def get_artist_albums(client, artist_id, release_types=None, skip_compilations=True, smart_discography=True):
+    '''
+    Returns the raw albums of an artist discography, all pages of it
+
+    Parameters
+    ----------
+    client: qopy.Client
+        qobuz_dl API client
+    artist_id: int
+        Qobuz artist ID
+    release_types: list
+        release types to keep, e.g. 'album', 'single', 'epmini'. All when empty
+    skip_compilations: bool
+        skip compilations and albums credited to other artists
+    smart_discography: bool
+        keep a single version of albums released several times, e.g. in
+        different qualities or remastered
+    '''
+    pages = list(client.get_artist_meta(artist_id))
+    name = pages[0]["name"]
+    albums = [album for page in pages for album in page["albums"]["items"]]
+    if release_types:
+        albums = [album for album in albums if album.get("release_type") in release_types]
+    if skip_compilations:
+        albums = [
+            album for album in albums
+            if album.get("release_type") != "compilation" and album["artist"]["name"] == name
+        ]
+    if smart_discography and albums:
+        albums = smart_discography_filter([{"name": name, "albums": {"items": albums}}], save_space=False)
+    return albums
+
+def create_download(qobuz: QobuzDL, item_id, **options):
+    '''
+    Returns a ParallelDownload set up like QobuzDL.download_from_id does, the
+    options are passed to ParallelDownload
+    '''
+    return ParallelDownload(
+        qobuz.client,
+        item_id,
+        qobuz.directory,
+        int(qobuz.quality),
+        qobuz.embed_art,
+        qobuz.ignore_singles_eps,
+        qobuz.quality_fallback,
+        qobuz.cover_og_quality,
+        qobuz.no_cover,
+        qobuz.folder_format,
+        qobuz.track_format,
+        **options,
+    )
+
+def download_album(qobuz: QobuzDL, album_id, **options):
+    '''
+    Downloads an album with its tracks fetched concurrently
+
+    Unlike QobuzDL.download_from_id errors are raised, and the album is only
+    added to the downloads database once every track is on disk.
+    '''
+    if qobuz.downloads_db.contains(album_id):
+        logger.info(f"This release ID ({album_id}) was already downloaded according to the local database.")
+        return
+    create_download(qobuz, album_id, **options).download_release()
+    qobuz.downloads_db.add(album_id)
+
+def download_track(qobuz: QobuzDL, track_id, **options):
+    '''
+    Downloads a single track, raising errors like download_album does
+    '''
+    if qobuz.downloads_db.contains(track_id):
+        logger.info(f"This track ID ({track_id}) was already downloaded according to the local database.")
+        return
+    create_download(qobuz, track_id, **options).download_track()
+    qobuz.downloads_db.add(track_id)
+
+def estimate_album(qobuz: QobuzDL, album_id, **options):
+    '''
+    Returns the number of files and bytes download_album would fetch, and
+    the URL of one of the files
+    '''
+    if qobuz.downloads_db.contains(album_id):
+        return 0, 0, None
+    return create_download(qobuz, album_id, **options).estimate_release()
+
+def estimate_track(qobuz: QobuzDL, track_id, **options):
+    '''
+    Returns the number of files and bytes download_track would fetch, and
+    the URL of the file
+    '''
+    if qobuz.downloads_db.contains(track_id):
+        return 0, 0, None
+    return create_download(qobuz, track_id, **options).estimate_track()
@@ -0,0 +1,96 @@
+import logging
+import time
+from threading import Lock
+from database import Database, batches, placeholders
+
+logger = logging.getLogger(__name__)
+
+class DownloadsDB(Database):
+    '''
+    SQLite database of the downloaded album and track ids, shared by every
+    worker
+
+    The ids are the primary key of a WITHOUT ROWID table, so looking one up
+    only walks a single B-tree. The database is in WAL mode and each thread
+    has its own connection, so lookups never wait for a write. Added ids are
+    buffered and written in batches, every batch_size ids or flush_interval
+    seconds and at the end of every run, buffered ids being already seen by
+    the lookups.
+
+    The downloads table stays readable and writable by qobuz_dl, a database
+    created by qobuz_dl is migrated on first use.
+
+    Parameters
+    ----------
+    path: str
+        location of the database file
+    batch_size: int
+        number of buffered ids that triggers a write
+    flush_interval: float
+        seconds after which buffered ids are written by the next addition
+    '''
+    schema_version = 1
+
+    def __init__(self, path, batch_size=100, flush_interval=10):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.lock = Lock()
+        self.pending = dict()
+        self.flushed_at = time.monotonic()
+        super().__init__(path)
+
+    def _upgrade(self, conn, version):
+        legacy = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='downloads'"
+        ).fetchone()
+        if legacy:
+            conn.execute("ALTER TABLE downloads RENAME TO downloads_legacy")
+        conn.execute(
+            "CREATE TABLE downloads (id TEXT PRIMARY KEY NOT NULL, downloaded_at REAL) WITHOUT ROWID"
+        )
+        if legacy:
+            conn.execute("INSERT OR IGNORE INTO downloads (id) SELECT id FROM downloads_legacy")
+            conn.execute("DROP TABLE downloads_legacy")
+            logger.info("Migrated the downloads database")
+
+    def contains(self, item_id):
+        item_id = str(item_id)
+        with self.lock:
+            if item_id in self.pending:
+                return True
+        return self._connection().execute(
+            "SELECT 1 FROM downloads WHERE id=?", (item_id,)
+        ).fetchone() is not None
+
+    def downloaded(self, item_ids):
+        '''Returns the given ids that were already downloaded, as strings'''
+        item_ids = [str(item_id) for item_id in item_ids]
+        with self.lock:
+            found = {item_id for item_id in item_ids if item_id in self.pending}
+        conn = self._connection()
+        for batch in batches(item_ids):
+            rows = conn.execute(f"SELECT id FROM downloads WHERE id IN ({placeholders(batch)})", batch)
+            found.update(row[0] for row in rows)
+        return found
+
+    def add(self, item_id):
+        with self.lock:
+            self.pending[str(item_id)] = time.time()
+            if len(self.pending) < self.batch_size and time.monotonic() - self.flushed_at < self.flush_interval:
+                return
+            self._flush()
+
+    def flush(self):
+        '''Writes the buffered ids'''
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.pending:
+            with self._connection() as conn:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO downloads (id, downloaded_at) VALUES (?, ?)",
+                    self.pending.items(),
+                )
+            self.pending.clear()
+        self.flushed_at = time.monotonic()
@@ -0,0 +1,111 @@
+import time
+from threading import Lock
+import requests
+from qobuz_dl.exceptions import IneligibleError, InvalidQuality, NonStreamable
+from download import IncompleteDownload
+from snapshot import load_json, save_json
+
+# HTTP statuses of releases that are removed or locked to another region
+permanent_status_codes = (400, 403, 404, 410)
+
+def is_permanent_error(e: Exception):
+    '''Tells whether retrying a failed favorite is unlikely to ever succeed'''
+    if isinstance(e, IncompleteDownload) and e.__cause__ is not None:
+        # judge a partly failed release by the error of its first failed track
+        return is_permanent_error(e.__cause__)
+    if isinstance(e, requests.exceptions.HTTPError) and e.response is not None:
+        return e.response.status_code in permanent_status_codes
+    return isinstance(e, (NonStreamable, IneligibleError, InvalidQuality))
+
+class FailureTable:
+    '''
+    Failed favorites and when to retry them, persisted as JSON between runs
+
+    Every failure pushes the next attempt further back, doubling the delay
+    each time up to max_delay. A favorite that failed max_attempts times in
+    a row with a permanent error, e.g. a removed or region-locked release,
+    is quarantined and not retried anymore until it is removed from the
+    file.
+
+    Parameters
+    ----------
+    path: str
+        location of the failures file
+    base_delay: int
+        seconds before the first retry
+    max_delay: int
+        longest delay in seconds between two retries
+    max_attempts: int
+        number of permanent failures after which a favorite is quarantined
+    '''
+    def __init__(self, path, base_delay=1800, max_delay=604800, max_attempts=5):
+        self.path = path
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.lock = Lock()
+        self.data = load_json(path, dict())
+
+    def _failures(self, fav_type):
+        return self.data.setdefault(fav_type, dict())
+
+    def is_eligible(self, fav_type, item_id):
+        '''Tells whether a favorite may be attempted now'''
+        with self.lock:
+            failure = self._failures(fav_type).get(str(item_id))
+        if failure is None:
+            return True
+        return not failure["quarantined"] and time.time() >= failure["next_attempt_at"]
+
+    def due(self, fav_type):
+        '''Returns the ids of the failed favorites that may be attempted again now'''
+        now = time.time()
+        with self.lock:
+            return [
+                item_id for item_id, failure in self._failures(fav_type).items()
+                if not failure["quarantined"] and now >= failure["next_attempt_at"]
+            ]
+
+    def is_quarantined(self, fav_type, item_id):
+        with self.lock:
+            return self._failures(fav_type).get(str(item_id), dict()).get("quarantined", False)
+
+    def add(self, fav_type, item_id, error: Exception):
+        '''Records a failed attempt and schedules the next one'''
+        now = time.time()
+        with self.lock:
+            failure = self._failures(fav_type).setdefault(str(item_id), {
+                "attempts": 0,
+                "permanent_attempts": 0,
+                "first_failed_at": now,
+            })
+            failure["attempts"] += 1
+            # only consecutive permanent errors lead to the quarantine
+            failure["permanent_attempts"] = failure["permanent_attempts"] + 1 if is_permanent_error(error) else 0
+            failure["error"] = type(error).__name__
+            failure["message"] = str(error)
+            failure["failed_at"] = now
+            delay = min(self.max_delay, self.base_delay * 2 ** (failure["attempts"] - 1))
+            failure["next_attempt_at"] = now + delay
+            failure["quarantined"] = failure["permanent_attempts"] >= self.max_attempts
+            return failure
+
+    def remove(self, fav_type, item_id):
+        with self.lock:
+            self._failures(fav_type).pop(str(item_id), None)
+
+    def prune(self, fav_type, is_favorite):
+        '''
+        Forgets the failed favorites for which is_favorite returns False, e.g.
+        the ones the user removed since. Returns the number of forgotten ones.
+        '''
+        with self.lock:
+            failures = self._failures(fav_type)
+            removed = [item_id for item_id in failures if not is_favorite(item_id)]
+            for item_id in removed:
+                del failures[item_id]
+        return len(removed)
+
+    def save(self):
+        with self.lock:
+            save_json(self.path, self.data)
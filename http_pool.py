@@ -0,0 +1,199 @@
+import logging
+import random
+import time
+from email.utils import parsedate_to_datetime
+from threading import Lock
+from urllib.parse import urljoin, urlparse
+import requests
+from requests.adapters import HTTPAdapter
+import qobuz.api as qobuz_api
+
+logger = logging.getLogger(__name__)
+
+# responses telling the client to slow down, retried after a backoff
+throttle_status_codes = (429, 502, 503, 504)
+
+def get_retry_after(response: requests.Response):
+    '''Returns the seconds to wait asked by the Retry-After header, if any'''
+    value = response.headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class AdaptiveRateLimiter:
+    '''
+    Request rate of a single host, learnt from its throttling responses
+
+    Every throttling response doubles the minimum interval between two
+    requests and blocks all of them for the time asked by Retry-After, or
+    for an exponential backoff with jitter. Successful responses slowly
+    bring the interval back down to no limit at all.
+
+    Parameters
+    ----------
+    max_interval: float
+        largest interval in seconds between two requests
+    max_backoff: float
+        longest time in seconds all requests are blocked after a throttling
+        response
+    '''
+    def __init__(self, max_interval=5.0, max_backoff=300.0):
+        self.max_interval = max_interval
+        self.max_backoff = max_backoff
+        self.lock = Lock()
+        self.interval = 0.0
+        self.next_request_at = 0.0
+        self.blocked_until = 0.0
+        self.failures = 0
+        self.throttled = 0
+
+    def wait(self):
+        '''Blocks until the next request may be sent'''
+        with self.lock:
+            now = time.monotonic()
+            request_at = max(now, self.blocked_until, self.next_request_at)
+            self.next_request_at = request_at + self.interval
+        if request_at > now:
+            time.sleep(request_at - now)
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.interval = self.interval * 0.9 if self.interval > 0.01 else 0.0
+
+    def throttle(self, retry_after=None):
+        '''Slows every request down after a throttling response'''
+        with self.lock:
+            self.throttled += 1
+            self.failures += 1
+            self.interval = min(self.max_interval, max(0.1, self.interval * 2))
+            if retry_after is None:
+                # full jitter, so that the workers don't all retry at once
+                retry_after = random.uniform(0, min(self.max_backoff, 2 ** self.failures))
+            retry_after = min(self.max_backoff, retry_after)
+            self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+            return retry_after
+
+class ThrottledAdapter(HTTPAdapter):
+    '''
+    HTTPAdapter that paces the requests of each host and retries the GET
+    and HEAD requests throttled by the server
+
+    Parameters
+    ----------
+    retries: int
+        number of times a throttled request is retried
+    **kwargs
+        AdaptiveRateLimiter and HTTPAdapter arguments
+    '''
+    def __init__(self, retries=5, max_interval=5.0, max_backoff=300.0, **kwargs):
+        super().__init__(**kwargs)
+        self.retries = retries
+        self.max_interval = max_interval
+        self.max_backoff = max_backoff
+        self.limiters = dict()
+        self.limiters_lock = Lock()
+
+    def limiter(self, url) -> AdaptiveRateLimiter:
+        host = urlparse(url).netloc
+        with self.limiters_lock:
+            if host not in self.limiters:
+                self.limiters[host] = AdaptiveRateLimiter(self.max_interval, self.max_backoff)
+            return self.limiters[host]
+
+    def throttled(self):
+        '''Returns the number of throttling responses received so far'''
+        with self.limiters_lock:
+            return sum(limiter.throttled for limiter in self.limiters.values())
+
+    def send(self, request, **kwargs):
+        limiter = self.limiter(request.url)
+        for attempt in range(self.retries + 1):
+            limiter.wait()
+            response = super().send(request, **kwargs)
+            if response.status_code not in throttle_status_codes:
+                limiter.success()
+                return response
+            delay = limiter.throttle(get_retry_after(response))
+            if attempt == self.retries or request.method not in ("GET", "HEAD"):
+                return response
+            logger.info(f"HTTP {response.status_code} from {urlparse(request.url).netloc}, retrying in {delay:.1f}s")
+            response.close()
+        return response
+
+class ConnectionPool:
+    '''
+    Keep-alive HTTP connection pool shared by every requests session
+
+    Sessions are cheap, the pooled connections live in the single adapter
+    mounted on all of them, so both API clients and the file downloads
+    reuse the same TLS connections. The adapter also paces the requests of
+    every session together when a host throttles them.
+
+    Parameters
+    ----------
+    pool_size: int
+        maximum number of kept-alive connections per host
+    retries: int
+        number of times a throttled request is retried
+    max_backoff: float
+        longest time in seconds requests are blocked after a throttling
+        response
+    '''
+    def __init__(self, pool_size=16, retries=5, max_backoff=300.0):
+        self.adapter = ThrottledAdapter(
+            retries=retries,
+            max_backoff=max_backoff,
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+        )
+
+    def mount(self, session: requests.Session):
+        session.mount("https://", self.adapter)
+        session.mount("http://", self.adapter)
+        return session
+
+    def session(self, headers=None):
+        session = self.mount(requests.Session())
+        if headers:
+            session.headers.update(headers)
+        return session
+
+    def stats(self):
+        '''Returns the number of opened connections and of requests sent so far'''
+        connections = 0
+        requests_sent = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                requests_sent += pool.num_requests
+        return connections, requests_sent
+
+def api_request(session: requests.Session, url, **params):
+    '''
+    Same as qobuz.api.request, but sent through the given session
+
+    Parameters
+    ----------
+    session: requests.Session
+        session of the shared connection pool
+    url: str
+        URL to be joined with qobuz.api.API_URL
+    **params
+        GET parameters to be added to the request
+    '''
+    params["app_id"] = qobuz_api.APP_ID
+    # for server-side caching sort alphabetically, like python-qobuz does
+    params = dict(sorted(params.items()))
+    r = session.get(urljoin(qobuz_api.API_URL, url), params=params)
+    r.raise_for_status()
+    return r.json()
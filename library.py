@@ -0,0 +1,284 @@
+import logging
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import mutagen.id3 as id3
+from mutagen import MutagenError
+from mutagen.flac import FLAC
+from database import Database, batches, placeholders
+
+logger = logging.getLogger(__name__)
+
+audio_extensions = (".flac", ".mp3")
+# below that number of changed files the tags are parsed in the calling thread
+parse_batch_size = 64
+
+# FLAC comments holding the ids, with the alternative names written by other taggers
+flac_id_tags = {
+    "isrc": ("ISRC",),
+    "upc": ("BARCODE", "UPC"),
+    "track_id": ("QOBUZ_TRACK_ID",),
+    "album_id": ("QOBUZ_ALBUM_ID",),
+}
+# ID3 frames holding the ids
+id3_id_tags = {
+    "isrc": ("TSRC",),
+    "upc": ("TXXX:BARCODE", "TXXX:UPC"),
+    "track_id": ("TXXX:QOBUZ_TRACK_ID",),
+    "album_id": ("TXXX:QOBUZ_ALBUM_ID",),
+}
+
+def get_track_ids(track_metadata: dict, album_metadata: dict):
+    '''Returns the ids identifying a track file, from the Qobuz metadata'''
+    return {
+        "isrc": track_metadata.get("isrc"),
+        "upc": album_metadata.get("upc"),
+        "track_id": str(track_metadata["id"]),
+        "album_id": str(album_metadata["id"]) if album_metadata.get("id") else None,
+    }
+
+def write_ids(path, ids: dict, is_mp3=False):
+    '''Tags a FLAC or mp3 file with its ISRC, UPC and Qobuz ids'''
+    if is_mp3:
+        try:
+            audio = id3.ID3(path)
+        except id3.ID3NoHeaderError:
+            audio = id3.ID3()
+        for key, frames in id3_id_tags.items():
+            if not ids.get(key):
+                continue
+            if frames[0] == "TSRC":
+                audio.add(id3.TSRC(encoding=3, text=ids[key]))
+            else:
+                audio.add(id3.TXXX(encoding=3, desc=frames[0].split(":", 1)[1], text=ids[key]))
+        audio.save(path, v2_version=3)
+        return
+    audio = FLAC(path)
+    for key, names in flac_id_tags.items():
+        if ids.get(key):
+            audio[names[0]] = ids[key]
+    audio.save()
+
+def read_ids(path):
+    '''Returns the ISRC, UPC and Qobuz ids found in the tags of a file'''
+    ids = dict.fromkeys(flac_id_tags)
+    try:
+        if path.lower().endswith(".mp3"):
+            tags = id3.ID3(path)
+            for key, frames in id3_id_tags.items():
+                for frame in frames:
+                    if frame in tags and tags[frame].text:
+                        ids[key] = str(tags[frame].text[0])
+                        break
+        else:
+            tags = FLAC(path).tags or dict()
+            for key, names in flac_id_tags.items():
+                for name in names:
+                    if tags.get(name):
+                        ids[key] = tags[name][0]
+                        break
+    except (MutagenError, OSError) as e:
+        logger.info(f"Could not read the tags of {path}: {e}")
+    return ids
+
+class LibraryIndex(Database):
+    '''
+    SQLite index of the audio files of the music directory, keyed by ISRC,
+    UPC and Qobuz ids
+
+    The index is built from the tags of the files, so that releases that
+    are already in the library are found even when they were downloaded
+    under another release id, or when the downloads database was lost.
+
+    update is incremental: directories whose modification time did not
+    change since the previous update are not listed again, only their
+    known subdirectories are visited. In the other directories only the
+    files whose inode, size or modification time changed are read again,
+    their tags being parsed in a thread pool so that reading the files from
+    a slow or network disk overlaps. Since editing a file in
+    place does not change the modification time of its directory, every
+    directory is listed again once per full_scan_interval.
+
+    Parameters
+    ----------
+    path: str
+        location of the index database
+    full_scan_interval: int
+        seconds after which every directory is listed again
+    workers: int
+        number of threads reading the tags
+    '''
+    schema_version = 2
+
+    def __init__(self, path, full_scan_interval=604800, workers=8):
+        self.full_scan_interval = full_scan_interval
+        self.workers = workers
+        self.lock = Lock()
+        super().__init__(path)
+
+    def _upgrade(self, conn, version):
+        # the index is only a cache of the tags, rebuild it from scratch
+        for table in ("files", "directories", "scans"):
+            conn.execute(f"DROP TABLE IF EXISTS {table}")
+        conn.execute(
+            "CREATE TABLE files ("
+            "path TEXT PRIMARY KEY NOT NULL, directory TEXT NOT NULL, "
+            "inode INTEGER, size INTEGER, mtime_ns INTEGER, "
+            "isrc TEXT, upc TEXT, track_id TEXT, album_id TEXT) WITHOUT ROWID"
+        )
+        for column in ("directory", *flac_id_tags):
+            conn.execute(f"CREATE INDEX files_{column} ON files ({column})")
+        conn.execute(
+            "CREATE TABLE directories (path TEXT PRIMARY KEY NOT NULL, mtime_ns INTEGER) WITHOUT ROWID"
+        )
+        conn.execute("CREATE TABLE scans (directory TEXT PRIMARY KEY NOT NULL, full_scan_at REAL) WITHOUT ROWID")
+
+    def update(self, directory):
+        '''
+        Indexes the files of directory that changed since the previous update,
+        and forgets the removed ones. Returns the number of files read and
+        removed.
+        '''
+        directory = os.path.abspath(directory)
+        conn = self._connection()
+        full_scan_at = conn.execute("SELECT full_scan_at FROM scans WHERE directory=?", (directory,)).fetchone()
+        full = full_scan_at is None or time.time() - full_scan_at[0] > self.full_scan_interval
+        directories = dict(conn.execute("SELECT path, mtime_ns FROM directories"))
+        subdirectories = defaultdict(list)
+        for path in directories:
+            subdirectories[os.path.dirname(path)].append(path)
+
+        changed = list()
+        removed = list()
+        removed_directories = list()
+        listed = dict()
+        stack = [directory]
+        while stack:
+            path = stack.pop()
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except OSError:
+                removed_directories.append(path)
+                continue
+            if not full and directories.get(path) == mtime_ns:
+                # same entries as last time, only the subdirectories may have changed
+                stack += subdirectories[path]
+                continue
+            listed[path] = mtime_ns
+            known = {
+                row[0]: tuple(row[1:])
+                for row in conn.execute("SELECT path, inode, size, mtime_ns FROM files WHERE directory=?", (path,))
+            }
+            children = set()
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            children.add(entry.path)
+                        elif entry.name.lower().endswith(audio_extensions) and not entry.name.startswith("."):
+                            stat = entry.stat()
+                            fingerprint = (entry.inode(), stat.st_size, stat.st_mtime_ns)
+                            if known.pop(entry.path, None) != fingerprint:
+                                changed.append((entry.path, path, *fingerprint))
+            except OSError as e:
+                logger.info(f"Could not list {path}: {e}")
+                del listed[path]
+                continue
+            # the files left in known are gone
+            removed += known
+            removed_directories += [child for child in subdirectories[path] if child not in children]
+            stack += children
+
+        rows = [
+            {"path": path, "directory": parent, "inode": inode, "size": size, "mtime_ns": mtime_ns, **ids}
+            for (path, parent, inode, size, mtime_ns), ids in zip(changed, self._read_ids(path for path, *_ in changed))
+        ]
+        with self.lock, conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO files VALUES "
+                "(:path, :directory, :inode, :size, :mtime_ns, :isrc, :upc, :track_id, :album_id)",
+                rows,
+            )
+            conn.executemany("DELETE FROM files WHERE path=?", ((path,) for path in removed))
+            for path in removed_directories:
+                # the directory and everything below it, the range of paths starting with path/
+                below = (path, path + "/", path + "0")
+                removed += [row[0] for row in conn.execute(
+                    "SELECT path FROM files WHERE directory=? OR (directory>=? AND directory<?)", below
+                )]
+                conn.execute("DELETE FROM files WHERE directory=? OR (directory>=? AND directory<?)", below)
+                conn.execute("DELETE FROM directories WHERE path=? OR (path>=? AND path<?)", below)
+            conn.executemany("INSERT OR REPLACE INTO directories VALUES (?, ?)", listed.items())
+            if full:
+                conn.execute("INSERT OR REPLACE INTO scans VALUES (?, ?)", (directory, time.time()))
+        return len(rows), len(removed)
+
+    def _read_ids(self, paths):
+        paths = list(paths)
+        if len(paths) < parse_batch_size or self.workers == 1:
+            return [read_ids(path) for path in paths]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(read_ids, paths))
+
+    def add(self, path, ids: dict):
+        '''Indexes a file that was just downloaded'''
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        conn = self._connection()
+        with self.lock, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO files VALUES "
+                "(:path, :directory, :inode, :size, :mtime_ns, :isrc, :upc, :track_id, :album_id)",
+                {
+                    "path": path,
+                    "directory": os.path.dirname(path),
+                    "inode": stat.st_ino,
+                    "size": stat.st_size,
+                    "mtime_ns": stat.st_mtime_ns,
+                    **ids,
+                },
+            )
+
+    def count(self):
+        return self._connection().execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def find_track(self, track_id, isrc=None):
+        '''Returns the path of a file of the track, or of the same recording'''
+        rows = self._connection().execute(
+            "SELECT path FROM files WHERE track_id=? UNION SELECT path FROM files WHERE isrc=?",
+            (str(track_id), isrc),
+        )
+        for (path,) in rows:
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def album_files(self, album_id, upc=None):
+        '''Returns the number of files of the album, found by id or UPC'''
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM (SELECT path FROM files WHERE album_id=? UNION SELECT path FROM files WHERE upc=?)",
+            (str(album_id), upc),
+        ).fetchone()[0]
+
+    def album_counts(self, album_ids):
+        '''Returns the number of files of each of the given albums found by id'''
+        counts = dict()
+        for batch in batches(album_ids):
+            rows = self._connection().execute(
+                f"SELECT album_id, COUNT(*) FROM files WHERE album_id IN ({placeholders(batch)}) GROUP BY album_id",
+                batch,
+            )
+            counts.update(rows)
+        return counts
+
+    def tracks(self, track_ids):
+        '''Returns the given track ids that have a file, as strings'''
+        found = set()
+        for batch in batches(track_ids):
+            rows = self._connection().execute(
+                f"SELECT track_id FROM files WHERE track_id IN ({placeholders(batch)})", batch
+            )
+            found.update(row[0] for row in rows)
+        return found
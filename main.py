@@ -1,12 +1,35 @@
+import copy
 import logging
 import os
 import schedule
 import time
-from threading import Thread, Event
+from itertools import islice, takewhile
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Event, local
 from qobuz_dl.core import QobuzDL
 from dotenv import load_dotenv
 import qobuz.api as qobuz_api
 import qobuz as qobuz_cl
+from auth import SessionCache, is_auth_error
+from coordinator import RunCoordinator
+from downloads_db import DownloadsDB
+from bandwidth import BandwidthLimiter, parse_schedule
+from failures import FailureTable
+from download import (
+    DownloadEstimate,
+    download_album,
+    download_track,
+    estimate_album,
+    estimate_track,
+    get_artist_albums,
+    measure_throughput,
+    transfer_stats,
+)
+from http_pool import ConnectionPool, api_request
+from library import LibraryIndex
+from pipeline import Favorite, FavoritesPipeline
+from snapshot import FavoritesSnapshot, load_json, save_json
+from trigger import install_signal_trigger, start_trigger_server
 
 logging.basicConfig(level=logging.INFO)
 load_dotenv()
@@ -17,16 +40,251 @@ qobuz_app_id = os.environ["QOBUZ_APP_ID"]
 music_directory = os.environ.get("MUSIC_DIRECTORY", "/downloads")
 config_directory = os.environ.get("CONFIG_DIRECTORY", "/config")
 quality = int(os.environ.get("QUALITY", 27))
+# index the tags of the music directory to skip releases that are already there
+library_index_enabled = os.environ.get("LIBRARY_INDEX", "true").lower() == "true"
+# only changed directories are listed, except every library_full_scan_interval seconds
+library_full_scan_interval = int(os.environ.get("LIBRARY_FULL_SCAN_INTERVAL", 604800))
+library_scan_workers = int(os.environ.get("LIBRARY_SCAN_WORKERS", 8))
+# only estimate the size and duration of the next run, then exit
+dry_run = os.environ.get("DRY_RUN", "false").lower() == "true"
+download_workers = int(os.environ.get("DOWNLOAD_WORKERS", 4))
+album_track_workers = int(os.environ.get("ALBUM_TRACK_WORKERS", 4))
+# split large track files in up to this many parallel range requests
+download_segments = int(os.environ.get("DOWNLOAD_SEGMENTS", 1))
+# largest page size accepted by favorite/getUserFavorites
+favorites_page_size = int(os.environ.get("FAVORITES_PAGE_SIZE", 500))
+favorites_page_workers = int(os.environ.get("FAVORITES_PAGE_WORKERS", 4))
+# seconds between two cheap checks of the favorites for changes
+favorites_poll_interval = int(os.environ.get("FAVORITES_POLL_INTERVAL", 60))
+# seconds after which a run starts even though the favorites did not change
+favorites_max_run_interval = int(os.environ.get("FAVORITES_MAX_RUN_INTERVAL", 86400))
+# local endpoint starting a run on POST /trigger, disabled with port 0
+trigger_host = os.environ.get("TRIGGER_HOST", "127.0.0.1")
+trigger_port = int(os.environ.get("TRIGGER_PORT", 0))
+favorites_full_sync_interval = int(os.environ.get("FAVORITES_FULL_SYNC_INTERVAL", 86400))
+session_ttl = int(os.environ.get("SESSION_TTL", 604800))
+# longest pause of the polling after consecutive login failures
+login_max_retry_delay = int(os.environ.get("LOGIN_MAX_RETRY_DELAY", 3600))
+# release types of the favorite artists discography to download, e.g. album,single,epmini
+artist_release_types = [t.strip() for t in os.environ.get("ARTIST_RELEASE_TYPES", "album").split(",") if t.strip()]
+artist_skip_compilations = os.environ.get("ARTIST_SKIP_COMPILATIONS", "true").lower() == "true"
+artist_smart_discography = os.environ.get("ARTIST_SMART_DISCOGRAPHY", "true").lower() == "true"
+# total download bandwidth in bytes per second, 0 for unlimited
+bandwidth_limit = int(os.environ.get("BANDWIDTH_LIMIT", 0))
+# time-of-day bandwidth windows, e.g. 08:00-23:00=2000000,23:00-08:00=0
+bandwidth_schedule = parse_schedule(os.environ.get("BANDWIDTH_SCHEDULE", ""))
+# order of the download queue, comma separated policies among priority, recency and size
+queue_policies = [p.strip() for p in os.environ.get("QUEUE_POLICY", "priority,recency").split(",") if p.strip()]
+# ids of the favorites, or of albums and tracks, downloaded first, in that order
+queue_priority_ids = [i.strip() for i in os.environ.get("QUEUE_PRIORITY_IDS", "").split(",") if i.strip()]
+# failed favorites are retried after failure_retry_delay seconds, doubled on every failure
+failure_retry_delay = int(os.environ.get("FAILURE_RETRY_DELAY", 1800))
+failure_max_retry_delay = int(os.environ.get("FAILURE_MAX_RETRY_DELAY", 604800))
+# permanently unavailable favorites are not retried after this many attempts
+failure_quarantine_attempts = int(os.environ.get("FAILURE_QUARANTINE_ATTEMPTS", 5))
+http_pool_size = int(os.environ.get("HTTP_POOL_SIZE", download_workers * album_track_workers * download_segments))
+# throttled requests (HTTP 429 and 5xx) are retried after a backoff of at most http_max_backoff seconds
+http_retries = int(os.environ.get("HTTP_RETRIES", 5))
+http_max_backoff = float(os.environ.get("HTTP_MAX_BACKOFF", 300))
 
-# this variable acts as a lock.
-job_running = False
+# set by SIGUSR1 and the trigger endpoint to start a run right away
+manual_trigger = Event()
 
 qobuz = QobuzDL(
     directory=music_directory,
     quality=quality,
-    downloads_db=os.path.join(config_directory, "db"),
     folder_format="{artist}/{artist} - {album}",
 )
+# replaces the qobuz_dl database path, every QobuzDL copy shares the connections
+qobuz.downloads_db = DownloadsDB(os.path.join(config_directory, "db"))
+
+# keep-alive connections shared by both API clients and the file downloads
+http_pool = ConnectionPool(http_pool_size, retries=http_retries, max_backoff=http_max_backoff)
+
+# files of the music directory by ISRC, UPC and Qobuz ids, updated before every run
+library_index = LibraryIndex(
+    os.path.join(config_directory, "library.db"),
+    full_scan_interval=library_full_scan_interval,
+    workers=library_scan_workers,
+) if library_index_enabled else None
+
+# bandwidth shared by all the downloads
+bandwidth_limiter = BandwidthLimiter(bandwidth_limit, bandwidth_schedule)
+
+# options of every album and track download
+download_options = {
+    "track_workers": album_track_workers,
+    "pool": http_pool,
+    "max_segments": download_segments,
+    "limiter": bandwidth_limiter,
+    "library": library_index,
+}
+
+# app id, secrets and tokens, so that runs don't log in again every time
+session_cache = SessionCache(os.path.join(config_directory, "session.json"), ttl=session_ttl)
+# consecutive login failures, and when polling may log in again
+login_backoff = {"failures": 0, "retry_at": 0}
+
+# throughput measured by the previous runs, used by the dry run estimates
+run_stats_path = os.path.join(config_directory, "stats.json")
+
+# favorites seen by the previous runs, stored next to the downloads db
+favorites_snapshot = FavoritesSnapshot(
+    os.path.join(config_directory, "favorites.json"),
+    full_sync_interval=favorites_full_sync_interval,
+)
+
+# failed favorites and when to retry them
+failure_table = FailureTable(
+    os.path.join(config_directory, "failures.json"),
+    base_delay=failure_retry_delay,
+    max_delay=failure_max_retry_delay,
+    max_attempts=failure_quarantine_attempts,
+)
+
+# single run at a time, favorites found in the meantime join the running one
+run_coordinator = RunCoordinator(
+    os.path.join(config_directory, "run.json"),
+    run=lambda: process_favorites(),
+    refresh=lambda pipeline: refresh_favorites(pipeline),
+)
+
+# every download worker gets its own QobuzDL copy
+worker_state = local()
+
+def get_worker_qobuz(qobuz: QobuzDL):
+    '''
+    Returns a per-thread copy of the QobuzDL instance
+
+    The copy shares the authenticated tokens of the client but has its own
+    requests session, so that workers never use the same session at once.
+    All sessions share the connections of the http_pool.
+    '''
+    if getattr(worker_state, "source", None) is not qobuz.client:
+        client = copy.copy(qobuz.client)
+        client.session = http_pool.session(qobuz.client.session.headers)
+        worker_qobuz = copy.copy(qobuz)
+        worker_qobuz.client = client
+        worker_state.source = qobuz.client
+        worker_state.qobuz = worker_qobuz
+    return worker_state.qobuz
+
+favorite_classes = {
+    "albums": qobuz_cl.Album,
+    "tracks": qobuz_cl.Track,
+    "artists": qobuz_cl.Artist,
+}
+
+def explicit_priority(favorite: Favorite, job_type, job_item):
+    # listed ids first, in the order of QUEUE_PRIORITY_IDS
+    ranks = [
+        queue_priority_ids.index(str(item_id))
+        for item_id in (favorite.item.id, job_item.id)
+        if str(item_id) in queue_priority_ids
+    ]
+    return min(ranks, default=len(queue_priority_ids))
+
+def recency_priority(favorite: Favorite, job_type, job_item):
+    # favorites listed for the first time first, then the latest seen ones,
+    # ties in the order of the API listing which is newest first
+    first_seen = favorites_snapshot.first_seen(favorite.fav_type, favorite.item.id)
+    return (-first_seen if first_seen else float("-inf"), favorite.position)
+
+def size_priority(favorite: Favorite, job_type, job_item):
+    # shortest first, the duration is only known for tracks, count about
+    # 4 minutes per album track
+    if job_type == "tracks":
+        return job_item.duration or 240
+    return (job_item.tracks_count or 10) * 240
+
+priority_policies = {
+    "priority": explicit_priority,
+    "recency": recency_priority,
+    "size": size_priority,
+}
+
+for policy in queue_policies:
+    if policy not in priority_policies:
+        raise ValueError(f"Unknown QUEUE_POLICY {policy}, expected one of {', '.join(priority_policies)}")
+
+def download_priority(favorite: Favorite, job_type, job_item):
+    '''Returns the key of a download in the queue, by order of the policies'''
+    return tuple(priority_policies[policy](favorite, job_type, job_item) for policy in queue_policies)
+
+def get_favorites_page(user: qobuz_cl.User, fav_type, limit, offset):
+    '''
+    Returns one page of raw user favorites along with the total favorites count
+    '''
+    favorites = api_request(
+        http_pool.session(),
+        "favorite/getUserFavorites",
+        type=fav_type,
+        limit=limit,
+        offset=offset,
+        user_auth_token=user.auth_token,
+    )[fav_type]
+    return favorites["items"], favorites.get("total")
+
+def iter_user_favorites(user: qobuz_cl.User, fav_type, limit=None, workers=None, snapshot: FavoritesSnapshot = None):
+    '''
+    Yields the user favorites lazily, one page of favorites at a time
+
+    The first page tells the total number of favorites, the remaining pages
+    are then prefetched concurrently and yielded in order.
+
+    With a snapshot of the previous run, favorites are listed newest first
+    only until an already known favorite is reached. If the total count adds
+    up, the rest is taken from the snapshot instead of being listed again.
+
+    Parameters
+    ----------
+    user: qobuz.User
+        logged in user
+    fav_type: str
+        favorites type: 'tracks', 'albums', 'artists'
+    limit: int
+        number of favorites requested per page
+    workers: int
+        maximum number of pages fetched at the same time
+    snapshot: FavoritesSnapshot
+        favorites seen by the previous runs, updated with the listed ones
+    '''
+    limit = limit or favorites_page_size
+    workers = workers or favorites_page_workers
+    favorite_class = favorite_classes[fav_type]
+    favs, total = get_favorites_page(user, fav_type, limit, 0)
+
+    if snapshot is not None and not snapshot.needs_full_sync(fav_type):
+        new_favs = list(takewhile(lambda fav: not snapshot.is_known(fav_type, fav["id"]), favs))
+        if len(new_favs) < len(favs) and total == len(new_favs) + snapshot.count(fav_type):
+            # only the newest favorites changed since the previous run
+            known_favs = snapshot.items(fav_type)
+            snapshot.add(fav_type, new_favs)
+            for fav in new_favs + known_favs:
+                yield favorite_class(fav)
+            return
+
+    listed = list(favs)
+    for fav in favs:
+        yield favorite_class(fav)
+    if total is None:
+        # no total count in the response, page until an empty page
+        offset = limit
+        while favs:
+            favs, _ = get_favorites_page(user, fav_type, limit, offset)
+            listed += favs
+            for fav in favs:
+                yield favorite_class(fav)
+            offset += limit
+    else:
+        offsets = range(limit, total, limit)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for favs, _ in executor.map(lambda offset: get_favorites_page(user, fav_type, limit, offset), offsets):
+                listed += favs
+                for fav in favs:
+                    yield favorite_class(fav)
+    if snapshot is not None:
+        snapshot.add(fav_type, listed, full_sync=True)
 
 def get_user_favorites(user: qobuz_cl.User, fav_type):
     '''
@@ -34,129 +292,404 @@ def get_user_favorites(user: qobuz_cl.User, fav_type):
 
     Parameters
     ----------
-    user: dict
-        returned by qobuz.User
+    user: qobuz.User
+        logged in user
     fav_type: str
         favorites type: 'tracks', 'albums', 'artists'
-    limi
     '''
-    limit = 50
-    offset = 0
-    favorites = list()
+    return list(iter_user_favorites(user, fav_type))
+
+def download_album_favorite(qobuz: QobuzDL, album: qobuz_cl.Album):
+    # download the album, fetching its tracks concurrently
+    download_album(get_worker_qobuz(qobuz), album.id, **download_options)
+
+def download_track_favorite(qobuz: QobuzDL, track: qobuz_cl.Track):
+    download_track(get_worker_qobuz(qobuz), track.id, **download_options)
+
+def resolve_artist_albums(qobuz: QobuzDL, artist: qobuz_cl.Artist):
+    '''
+    Returns the albums of the artist discography that were not downloaded yet
+    '''
+    worker_qobuz = get_worker_qobuz(qobuz)
+    albums = get_artist_albums(
+        worker_qobuz.client,
+        artist.id,
+        release_types=artist_release_types,
+        skip_compilations=artist_skip_compilations,
+        smart_discography=artist_smart_discography,
+    )
+    downloaded = worker_qobuz.downloads_db.downloaded(album["id"] for album in albums)
+    albums = [album for album in albums if str(album["id"]) not in downloaded]
+    return [qobuz_cl.Album(album) for album in albums]
+
+def resolve_favorite(pipeline: FavoritesPipeline, fav_type, fav):
+    '''
+    Returns the (type, item) album and track downloads a favorite resolves to
+    '''
+    if fav_type == "artists":
+        return [("albums", album) for album in resolve_artist_albums(qobuz, fav)]
+    if fav_type == "tracks" and pipeline.is_scheduled("albums", fav.album.id):
+        # the whole album of the track is downloaded anyway
+        return [("albums", fav.album)]
+    return [(fav_type, fav)]
+
+def skip_downloaded(pipeline: FavoritesPipeline, fav_type, favorites):
+    '''
+    Yields the favorites that were not downloaded yet
+
+    The favorites are looked up in the downloads database and the library
+    index with bulk queries, once per page of favorites. The ones already
+    downloaded, or whose album was, are handed to the pipeline as done, so
+    they are removed from the favorites without any request.
+    '''
+    if fav_type == "artists":
+        # artists are not in the database, only their albums are
+        yield from favorites
+        return
+    favorites = iter(favorites)
     while True:
-        favs = user.favorites_get(fav_type=fav_type, limit=limit, offset=offset)
-        if not favs:
-            break
-        favorites += favs
-        offset += limit
-    return favorites
-
-def download_albums(qobuz: QobuzDL, user: qobuz_cl.User, albums: list[qobuz_cl.Album]):
-    successful_albums = list()
-    failure_albums = list()
-    for album in albums:
-        try:
-            # attempt to download the album
-            qobuz.download_from_id(album.id)
-            # if download is successful, remove from favorites
-            user.favorites_del(album)
-            # add to successful albums
-            successful_albums.append(album)
-        except Exception as e:
-            # add to failure albums
-            failure_albums.append(album)
-            # handle any exceptions that occur
-            print(f"An error occurred with album ID {album.id}: {e}")
-    return successful_albums, failure_albums
-
-def download_tracks(qobuz: QobuzDL, user: qobuz_cl.User, tracks: list[qobuz_cl.Track]):
-    successful_tracks = list()
-    failure_tracks = list()
-    for track in tracks:
-        try:
-            # attempt to download the track
-            qobuz.download_from_id(track.id, False)
-            # if download is successful, remove from favorites
-            user.favorites_del(track)
-            # add to successful tracks
-            successful_tracks.append(track)
-        except Exception as e:
-            # add to failure tracks
-            failure_tracks.append(track)
-            # handle any exceptions that occur
-            print(f"An error occurred with track ID {track.id}: {e}")
-    return successful_tracks, failure_tracks
-
-def download_artists(qobuz: QobuzDL, user: qobuz_cl.User, artists: list[qobuz_cl.Artist]):
-    successful_artists = list()
-    failure_artists = list()
-    for artist in artists:
+        batch = list(islice(favorites, favorites_page_size))
+        if not batch:
+            return
+        item_ids = [fav.id for fav in batch]
+        if fav_type == "tracks":
+            item_ids += [fav.album.id for fav in batch]
+        downloaded = qobuz.downloads_db.downloaded(item_ids)
+        if library_index is not None:
+            if fav_type == "tracks":
+                downloaded |= library_index.tracks(fav.id for fav in batch)
+            else:
+                # albums only count once all of their tracks are there
+                counts = library_index.album_counts(item_ids)
+                downloaded |= {str(fav.id) for fav in batch if counts.get(str(fav.id), 0) >= (fav.tracks_count or 1)}
+        for fav in batch:
+            if str(fav.id) in downloaded or (fav_type == "tracks" and str(fav.album.id) in downloaded):
+                pipeline.skip(fav_type, fav)
+            else:
+                yield fav
+
+def enqueue_favorites(user: qobuz_cl.User, pipeline: FavoritesPipeline, fav_type, favorites=None):
+    '''
+    Lists the user favorites page by page, submitting every favorite to the
+    pipeline as soon as its page arrives
+
+    Favorites already downloaded are skipped and removed right away.
+    Favorites that failed recently are left for a later run, quarantined
+    ones are not attempted at all.
+    '''
+    if favorites is None:
+        favorites = iter_user_favorites(user, fav_type, snapshot=favorites_snapshot)
+    deferred = 0
+    quarantined = 0
+
+    def is_eligible(fav):
+        nonlocal deferred, quarantined
+        if failure_table.is_eligible(fav_type, fav.id):
+            return True
+        # known to the run, so that refreshes don't list it again
+        pipeline.defer(fav_type, fav)
+        if failure_table.is_quarantined(fav_type, fav.id):
+            quarantined += 1
+        else:
+            deferred += 1
+        return False
+
+    def resolve(fav):
         try:
-            # attempt to download the artist
-            qobuz.download_from_id(artist.id, False)
-            # if download is successful, remove from favorites
-            user.favorites_del(artist)
-            # add to successful artists
-            successful_artists.append(artist)
+            return fav, resolve_favorite(pipeline, fav_type, fav), None
         except Exception as e:
-            # add to failure artists
-            failure_artists.append(artist)
-            # handle any exceptions that occur
-            print(f"An error occurred with artist ID {artist.id}: {e}")
-    return successful_artists, failure_artists
+            print(f"An error occurred with {fav.type} ID {fav.id}: {e}")
+            return fav, None, e
+
+    count = 0
+    with ThreadPoolExecutor(max_workers=favorites_page_workers) as executor:
+        # resolving artists costs requests, resolve several of them at once
+        favorites = filter(is_eligible, skip_downloaded(pipeline, fav_type, favorites))
+        resolved = executor.map(resolve, favorites) if fav_type == "artists" else map(resolve, favorites)
+        for fav, jobs, error in resolved:
+            if error is None:
+                pipeline.submit(fav_type, fav, jobs)
+            else:
+                pipeline.fail(fav_type, fav, error)
+            count += 1
+    print(f"Processing {count} {fav_type}...")
+    if deferred:
+        print(f"Deferring {deferred} {fav_type} that failed before to a later run.")
+    if quarantined:
+        print(f"Skipping {quarantined} quarantined {fav_type}, listed in failures.json.")
+
+def plan_favorites(user: qobuz_cl.User, pipeline: FavoritesPipeline):
+    '''
+    Lists every favorite and submits the downloads it resolves to
 
-def process_favorites():
+    Albums and artists are planned first, so that favorite tracks whose
+    album is downloaded anyway, directly or as part of a favorite artist,
+    wait for that album instead of being downloaded twice.
+    '''
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        # list the tracks in the meantime, they are only submitted last
+        tracks = executor.submit(lambda: list(iter_user_favorites(user, "tracks", snapshot=favorites_snapshot)))
+        list(executor.map(
+            lambda fav_type: enqueue_favorites(user, pipeline, fav_type),
+            ("albums", "artists"),
+        ))
+        enqueue_favorites(user, pipeline, "tracks", tracks.result())
+
+def login():
+    try:
+        qobuz_user = session_cache.login(qobuz, qobuz_email, qobuz_pasword)
+    except Exception:
+        login_failed()
+        raise
+    login_backoff["failures"] = 0
+    # route the qobuz_dl API calls through the shared connection pool
+    http_pool.mount(qobuz.client.session)
+    return qobuz_user
+
+def login_failed():
+    '''Pauses the polling, twice as long after every consecutive login failure'''
+    login_backoff["failures"] += 1
+    delay = min(login_max_retry_delay, favorites_poll_interval * 2 ** login_backoff["failures"])
+    login_backoff["retry_at"] = time.time() + delay
+    print(f"Login failed {login_backoff['failures']} times in a row, polling again in {delay}s.")
+
+def handle_download_failure(fav_type, item, e):
+    if is_auth_error(e):
+        if session_cache.is_valid():
+            # the cached tokens were rejected, log in again on the next run
+            session_cache.invalidate()
+        # not the favorite's fault, retry it on the next run
+        return
+    failure = failure_table.add(fav_type, item.id, e)
+    if failure["quarantined"]:
+        print(f"Giving up on {item.type} ID {item.id} after {failure['attempts']} attempts: {e}")
+
+def record_throughput(size, elapsed):
+    '''
+    Updates the measured download throughput with the one of the last run
+    '''
+    # ignore runs that downloaded too little to be meaningful
+    if size < 10 * 1024 * 1024 or elapsed <= 0:
+        return
+    run_stats = load_json(run_stats_path, dict())
+    throughput = size / elapsed
+    previous = run_stats.get("throughput")
+    run_stats["throughput"] = throughput if previous is None else (previous + throughput) / 2
+    save_json(run_stats_path, run_stats)
+
+def run_favorites(qobuz_user: qobuz_cl.User, estimate: DownloadEstimate = None):
+    '''
+    Plans and downloads the favorites, or only estimates their size when an
+    estimate is given
+    '''
+    if estimate is None:
+        downloaders = {
+            "tracks": lambda track: download_track_favorite(qobuz, track),
+            "albums": lambda album: download_album_favorite(qobuz, album),
+        }
+    else:
+        downloaders = {
+            "tracks": lambda track: estimate.add(*estimate_track(get_worker_qobuz(qobuz), track.id, **download_options)),
+            "albums": lambda album: estimate.add(*estimate_album(get_worker_qobuz(qobuz), album.id, **download_options)),
+        }
+    # downloads start as soon as the first page of favorites is listed
+    pipeline = FavoritesPipeline(
+        qobuz_user,
+        downloaders,
+        download_workers,
+        http_pool,
+        # dry runs don't count as attempts
+        on_failure=handle_download_failure if estimate is None else None,
+        remove_favorites=estimate is None,
+        priority=download_priority,
+    )
+    started_at = time.time()
+    transferred = transfer_stats.bytes
+    pipeline.start()
     try:
-        # initialize the Qobuz client
-        qobuz.get_tokens()
-        qobuz.initialize_client(qobuz_email, qobuz_pasword, qobuz.app_id, qobuz.secrets)
+        plan_favorites(qobuz_user, pipeline)
+        pipeline.listing_finished()
+        if estimate is None:
+            # new favorites may join once every type is planned, tracks must
+            # not be submitted before the albums and artists covering them
+            run_coordinator.attach(pipeline)
+        pipeline.wait_downloads()
+    finally:
+        run_coordinator.detach()
+        # wait for the downloads and favorites removals to finish
+        pipeline.close()
+        qobuz.downloads_db.flush()
+        if estimate is None:
+            # forget the favorites that were downloaded and removed
+            for fav_type, items in pipeline.successful.items():
+                for item in items:
+                    failure_table.remove(fav_type, item.id)
+                    if item not in pipeline.unfavorite_failure:
+                        favorites_snapshot.remove(fav_type, item.id)
+            for fav_type in favorite_classes:
+                # after a full listing, forget the failures of favorites the user removed
+                if (favorites_snapshot.synced_at(fav_type) or 0) >= started_at:
+                    failure_table.prune(fav_type, lambda item_id: favorites_snapshot.is_known(fav_type, item_id))
+            favorites_snapshot.save()
+            failure_table.save()
+            record_throughput(transfer_stats.bytes - transferred, time.time() - started_at)
+    return pipeline
 
+def print_estimate(estimate: DownloadEstimate):
+    print(f"Planned download: {estimate.files} files, {estimate.bytes / 1024 ** 3:.2f} GB.")
+    throughput = load_json(run_stats_path, dict()).get("throughput")
+    measured = "by the previous runs"
+    if throughput is None and estimate.sample_url is not None:
+        # no run yet, time the download of the start of a planned file
+        throughput = measure_throughput(http_pool.session(), estimate.sample_url, limiter=bandwidth_limiter)
+        measured = "on a single file"
+    if throughput is None:
+        print("No throughput measured yet, the duration will be known after the first run.")
+        return
+    duration = estimate.bytes / throughput
+    print(f"Projected duration: {duration / 3600:.1f} hours at {throughput / 1024 ** 2:.1f} MB/s measured {measured}.")
+
+def print_queue_waits(pipeline: FavoritesPipeline, limit=20):
+    '''Prints how long the downloads waited in the queue, longest first'''
+    jobs = sorted(pipeline.started, key=lambda job: job.wait, reverse=True)
+    if not jobs:
+        return
+    average = sum(job.wait for job in jobs) / len(jobs)
+    print(f"Queue wait: {average:.1f}s on average, {jobs[0].wait:.1f}s at most.")
+    for job in jobs[:limit]:
+        print(f"  {job.item.type} ID {job.item.id} waited {job.wait:.1f}s")
+    if len(jobs) > limit:
+        print(f"  and {len(jobs) - limit} more.")
+
+def process_favorites(dry_run=False):
+    '''
+    Downloads the favorites and removes them from the user's favorites
+
+    With dry_run nothing is downloaded nor removed, the favorites are only
+    resolved like in a real run to print the size and projected duration.
+    '''
+    try:
         # register your APP_ID
         qobuz_api.register_app(qobuz_app_id)
-        qobuz_user = qobuz_cl.User(qobuz_email, qobuz_pasword)
 
-        # retrieve favorites
-        favorite_albums = get_user_favorites(qobuz_user, fav_type="albums")
-        favorite_tracks = get_user_favorites(qobuz_user, fav_type="tracks")
-        favorite_artists = get_user_favorites(qobuz_user, fav_type="artists")
+        if library_index is not None:
+            started_at = time.time()
+            updated, removed = library_index.update(music_directory)
+            print(f"Library index: {library_index.count()} files, {updated} updated and {removed} removed in {time.time() - started_at:.1f}s.")
+
+        connections, requests_sent = http_pool.stats()
+        throttled = http_pool.adapter.throttled()
+        estimate = DownloadEstimate() if dry_run else None
 
-        print(f"Processing {len(favorite_albums)} albums...")
-        print(f"Processing {len(favorite_tracks)} tracks...")
-        print(f"Processing {len(favorite_artists)} artists...")
+        # initialize the Qobuz clients, reusing the cached session if any
+        try:
+            pipeline = run_favorites(login(), estimate)
+        except Exception as e:
+            if not is_auth_error(e):
+                raise
+            # the cached session was rejected, log in again and retry once
+            session_cache.invalidate()
+            estimate = DownloadEstimate() if dry_run else None
+            pipeline = run_favorites(login(), estimate)
 
-        # download new favorites
-        successful_tracks, failure_tracks = download_tracks(qobuz, qobuz_user, favorite_tracks)
-        successful_albums, failue_albums = download_albums(qobuz, qobuz_user, favorite_albums)
-        successful_artists, failure_artists = download_artists(qobuz, qobuz_user, favorite_artists)
+        if dry_run:
+            print_estimate(estimate)
+            return
 
         # print results
-        print(f"Successfully downloaded {len(successful_tracks)} tracks.")
-        print(f"Successfully downloaded {len(successful_albums)} albums.")
-        print(f"Successfully downloaded {len(successful_artists)} artists.")
+        for fav_type in ("tracks", "albums", "artists"):
+            print(f"Successfully downloaded {len(pipeline.successful[fav_type])} {fav_type}.")
+        for fav_type in ("tracks", "albums", "artists"):
+            print(f"Failed to download {len(pipeline.failure[fav_type])} {fav_type}.")
+        if pipeline.skipped:
+            print(f"Skipped {pipeline.skipped} favorites that were already downloaded, they were only removed from favorites.")
+        if pipeline.duplicates:
+            print(f"Skipped {pipeline.duplicates} downloads already covered by another favorite.")
+        if pipeline.unfavorite_failure:
+            print(f"Failed to remove {len(pipeline.unfavorite_failure)} downloads from favorites.")
+        print_queue_waits(pipeline)
 
-        print(f"Failed to download {len(failure_tracks)} tracks.")
-        print(f"Failed to download {len(failue_albums)} albums.")
-        print(f"Failed to download {len(failure_artists)} artists.")
+        connections_after, requests_sent_after = http_pool.stats()
+        new_connections = connections_after - connections
+        reused_connections = requests_sent_after - requests_sent - new_connections
+        print(f"HTTP connections: {new_connections} new, {reused_connections} reused.")
+        throttled = http_pool.adapter.throttled() - throttled
+        if throttled:
+            print(f"Slowed down after {throttled} throttled HTTP responses.")
     except Exception as e:
         # handle exceptions (e.g., network issues, data access problems)
         print(f"An error occurred: {e}")
 
-def job():
-    global job_running
-    if job_running:
-        print("A job is already running. Exiting this schedule.")
+def favorites_changed(user: qobuz_cl.User):
+    '''
+    Tells whether the favorites changed since the last run, at the cost of
+    one single favorite request per type
+
+    The total count and newest favorite of each type are compared with the
+    snapshot, which holds the favorites left by the last run. Only the
+    newest favorite is compared when the response has no total count.
+    '''
+    for fav_type in favorite_classes:
+        favs, total = get_favorites_page(user, fav_type, 1, 0)
+        if total is not None and total != favorites_snapshot.count(fav_type):
+            return True
+        if favs and not favorites_snapshot.is_known(fav_type, favs[0]["id"]):
+            return True
+    return False
+
+def failures_due():
+    '''Tells whether a favorite that failed before may be attempted again'''
+    for fav_type in favorite_classes:
+        for item_id in failure_table.due(fav_type):
+            # ignore the failures of favorites removed by the user since
+            if favorites_snapshot.is_known(fav_type, item_id):
+                return True
+    return False
+
+def refresh_favorites(pipeline: FavoritesPipeline):
+    '''
+    Submits the favorites added since the run in progress listed them
+
+    Favorites are listed newest first, so only the first page is listed,
+    and only when the newest favorite is not known to the run yet, i.e.
+    neither submitted nor deferred after a recent failure.
+    '''
+    for fav_type in ("albums", "artists", "tracks"):
+        favs, _ = get_favorites_page(pipeline.user, fav_type, 1, 0)
+        if not favs or pipeline.is_known(fav_type, favs[0]["id"]):
+            continue
+        favs, _ = get_favorites_page(pipeline.user, fav_type, favorites_page_size, 0)
+        new_favs = [fav for fav in favs if not pipeline.is_known(fav_type, fav["id"])]
+        favorites_snapshot.add(fav_type, new_favs)
+        enqueue_favorites(pipeline.user, pipeline, fav_type, [favorite_classes[fav_type](fav) for fav in new_favs])
+
+def poll_job():
+    '''Starts a run only when the favorites changed or a retry is due'''
+    if run_coordinator.is_running():
+        # look for new favorites to add to the run in progress
+        run_coordinator.refresh()
+        return
+    if time.time() < login_backoff["retry_at"]:
+        # logging in keeps failing, don't try again on every tick
+        return
+    if time.time() - run_coordinator.last_finished_at() >= favorites_max_run_interval or failures_due():
+        job()
+        return
+    try:
+        qobuz_api.register_app(qobuz_app_id)
+        changed = favorites_changed(login())
+    except Exception as e:
+        if is_auth_error(e):
+            session_cache.invalidate()
+        print(f"An error occurred checking the favorites: {e}")
         return
+    if changed:
+        job()
 
-    # set the lock
-    job_running = True
-    print("Job started!")
-    
-    # run job
-    process_favorites()
-    
-    # release the lock
-    job_running = False
-    print("Job finished!")
+def job(reason="schedule"):
+    # runs in the background, or adds the new favorites to the running one
+    if not run_coordinator.trigger(reason):
+        print("A job is already running, new favorites were added to it.")
 
 def run_continuously(interval=1):
     """Continuously run, while executing pending jobs at each elapsed time interval."""
@@ -166,14 +699,25 @@ def run_continuously(interval=1):
         @classmethod
         def run(cls):
             while not cease_continuous_run.is_set():
+                if manual_trigger.is_set():
+                    manual_trigger.clear()
+                    job("manual")
                 schedule.run_pending()
-                time.sleep(interval)
+                # woken up early by a manual trigger
+                manual_trigger.wait(interval)
 
     continuous_thread = ScheduleThread()
     continuous_thread.start()
     return cease_continuous_run
 
-schedule.every(3600).seconds.do(job)
+if dry_run:
+    process_favorites(dry_run=True)
+else:
+    # poll the favorites cheaply, the full run only starts on changes
+    schedule.every(favorites_poll_interval).seconds.do(poll_job)
+    install_signal_trigger(manual_trigger)
+    if trigger_port:
+        start_trigger_server(manual_trigger, trigger_host, trigger_port)
 
-# start the background thread
-stop_run_continuously = run_continuously()
\ No newline at end of file
+    # start the background thread
+    stop_run_continuously = run_continuously()
@@ -0,0 +1,323 @@
+import queue
+import time
+from collections import defaultdict
+from itertools import count
+from threading import Thread, Event, Lock, Condition
+import qobuz as qobuz_cl
+from http_pool import ConnectionPool, api_request
+
+# request parameter holding the comma separated ids of each favorites type
+favorite_ids_params = {
+    "albums": "album_ids",
+    "tracks": "track_ids",
+    "artists": "artist_ids",
+}
+
+def delete_favorites(pool: ConnectionPool, user: qobuz_cl.User, fav_type, items: list):
+    '''
+    Removes several favorites of the same type with a single request
+    '''
+    status = api_request(
+        pool.session(),
+        "favorite/delete",
+        user_auth_token=user.auth_token,
+        **{favorite_ids_params[fav_type]: ",".join(str(item.id) for item in items)},
+    )
+    if status.get("status") != "success":
+        raise RuntimeError(f"unexpected favorite/delete response: {status}")
+
+class Favorite:
+    '''
+    Favorite of the user, done once every download it resolves to is done
+    '''
+    def __init__(self, fav_type, item, position=0):
+        self.fav_type = fav_type
+        self.item = item
+        # rank of the favorite in the listing of its type
+        self.position = position
+        self.pending = 0
+        self.error = None
+
+class DownloadJob:
+    '''
+    Single album or track download, shared by every favorite covering it
+    '''
+    def __init__(self, fav_type, item):
+        self.fav_type = fav_type
+        self.item = item
+        self.favorites = list()
+        self.priority = ()
+        self.queued_at = None
+        self.wait = None
+        self.started = False
+        self.done = False
+        self.error = None
+
+class FavoritesPipeline:
+    '''
+    Downloads favorites while they are still being listed
+
+    Favorites are submitted one by one by the producer, downloaded by a pool
+    of worker threads as soon as they arrive, and every successful item is
+    handed to a third stage that removes it from the user's favorites. The
+    removals only start once listing is finished, since removing favorites
+    shifts the offsets of the pages that are still to be listed. They are
+    sent in batches of one request per favorites type, waiting up to
+    batch_linger seconds for more downloads to finish before sending a
+    batch, and retried with backoff without downloading anything again.
+
+    A favorite resolves to one or more download jobs, e.g. an artist to the
+    albums of its discography. Every album or track is downloaded at most
+    once, the favorites covering the same job all wait for its result.
+
+    Downloads are taken from a priority queue, in the order of the keys
+    returned by the priority function for every favorite covering them. A
+    download that is still queued moves up when a favorite with a better
+    key covers it too.
+
+    Parameters
+    ----------
+    user: qobuz.User
+        user whose favorites are processed
+    downloaders: dict
+        download function for each job type: 'tracks', 'albums'
+    workers: int
+        number of concurrent downloads
+    pool: ConnectionPool
+        connection pool used to remove the favorites
+    batch_size: int
+        maximum number of favorites removed in one go
+    batch_linger: float
+        seconds a batch of removals waits for more favorites before it is sent
+    retries: int
+        number of times a failed removal is retried
+    on_failure: function
+        called with the favorites type, the item and the exception of every
+        failed favorite
+    remove_favorites: bool
+        remove the successful favorites, False for dry runs
+    priority: function
+        called with the Favorite, the download type and item, returns the
+        key of the download in the queue, lowest first. Downloads are taken
+        in the order they are submitted when None.
+    '''
+    def __init__(self, user: qobuz_cl.User, downloaders: dict, workers: int, pool: ConnectionPool,
+                 batch_size=50, batch_linger=5, retries=3, on_failure=None, remove_favorites=True, priority=None):
+        self.user = user
+        self.priority = priority
+        self.remove_favorites = remove_favorites
+        self.pool = pool
+        self.retries = retries
+        self.on_failure = on_failure
+        self.downloaders = downloaders
+        self.batch_size = batch_size
+        self.batch_linger = batch_linger
+        self.downloads = queue.PriorityQueue()
+        # breaks ties between equal keys, in submission order
+        self.sequence = count()
+        self.positions = defaultdict(count)
+        self.unfavorites = queue.Queue()
+        self.listed = Event()
+        self.lock = Lock()
+        # notified when the last scheduled download is done
+        self.idle = Condition(self.lock)
+        self.unfinished = 0
+        self.jobs = dict()
+        # (type, id) of the submitted favorites, and of the ones left for a later run
+        self.submitted = set()
+        self.deferred = set()
+        self.duplicates = 0
+        self.skipped = 0
+        self.successful = defaultdict(list)
+        self.failure = defaultdict(list)
+        self.unfavorite_failure = list()
+        # started downloads, with the time they waited in the queue
+        self.started = list()
+        self.workers = [Thread(target=self._download_worker, daemon=True) for _ in range(workers)]
+        self.unfavoriter = Thread(target=self._unfavorite_worker, daemon=True)
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        self.unfavoriter.start()
+
+    def is_scheduled(self, fav_type, item_id):
+        with self.lock:
+            return (fav_type, item_id) in self.jobs
+
+    def is_known(self, fav_type, item_id):
+        '''Tells whether a favorite was already submitted or deferred'''
+        with self.lock:
+            return (fav_type, item_id) in self.submitted or (fav_type, item_id) in self.deferred
+
+    def defer(self, fav_type, item):
+        '''Records a favorite that is left for a later run, e.g. after a recent failure'''
+        with self.lock:
+            self.deferred.add((fav_type, item.id))
+
+    def submit(self, fav_type, item, jobs: list = None):
+        '''
+        Submits a favorite along with the (type, item) downloads it resolves
+        to, by default the favorite itself. Downloads already scheduled by
+        another favorite are not scheduled again, favorites already
+        submitted are ignored and False is returned.
+        '''
+        jobs = [(fav_type, item)] if jobs is None else jobs
+        finished = list()
+        with self.lock:
+            if (fav_type, item.id) in self.submitted:
+                return False
+            self.submitted.add((fav_type, item.id))
+            favorite = Favorite(fav_type, item, next(self.positions[fav_type]))
+            # hold the favorite until all of its jobs are registered
+            favorite.pending = len(jobs) + 1
+            for job_type, job_item in jobs:
+                priority = () if self.priority is None else self.priority(favorite, job_type, job_item)
+                job = self.jobs.get((job_type, job_item.id))
+                if job is None:
+                    job = self.jobs[(job_type, job_item.id)] = DownloadJob(job_type, job_item)
+                    job.priority = priority
+                    job.queued_at = time.monotonic()
+                    self.unfinished += 1
+                    self._schedule(job)
+                else:
+                    self.duplicates += 1
+                    if not job.started and priority < job.priority:
+                        # queue it again with the better key, the stale entry is skipped
+                        job.priority = priority
+                        self._schedule(job)
+                if job.done:
+                    finished.append(job.error)
+                else:
+                    job.favorites.append(favorite)
+        for error in finished:
+            self._job_finished(favorite, error)
+        self._job_finished(favorite)
+        return True
+
+    def skip(self, fav_type, item):
+        '''Records a favorite that was already downloaded, it is only removed from the favorites'''
+        if self.submit(fav_type, item, []):
+            with self.lock:
+                self.skipped += 1
+
+    def fail(self, fav_type, item, error: Exception):
+        '''Records a favorite that could not be resolved to downloads'''
+        with self.lock:
+            if (fav_type, item.id) in self.submitted:
+                return
+            self.submitted.add((fav_type, item.id))
+            favorite = Favorite(fav_type, item, next(self.positions[fav_type]))
+        favorite.pending = 1
+        self._job_finished(favorite, error)
+
+    def listing_finished(self):
+        self.listed.set()
+
+    def wait_downloads(self):
+        '''Waits for every download submitted so far, including the ones submitted meanwhile'''
+        with self.idle:
+            while self.unfinished:
+                self.idle.wait()
+
+    def close(self):
+        '''Waits for every submitted favorite to be downloaded and removed'''
+        self.listing_finished()
+        for _ in self.workers:
+            # sorted after every download
+            self.downloads.put((1, (), next(self.sequence), None))
+        for worker in self.workers:
+            worker.join()
+        self.unfavorites.put(None)
+        self.unfavoriter.join()
+
+    def _schedule(self, job: DownloadJob):
+        self.downloads.put((0, job.priority, next(self.sequence), job))
+
+    def _download_worker(self):
+        while True:
+            _, _, _, job = self.downloads.get()
+            if job is None:
+                return
+            with self.lock:
+                if job.started:
+                    continue
+                job.started = True
+                job.wait = time.monotonic() - job.queued_at
+                self.started.append(job)
+            error = None
+            try:
+                # attempt to download the album or track
+                self.downloaders[job.fav_type](job.item)
+            except Exception as e:
+                error = e
+                print(f"An error occurred with {job.item.type} ID {job.item.id}: {e}")
+            with self.lock:
+                job.done = True
+                job.error = error
+                favorites = list(job.favorites)
+                self.unfinished -= 1
+                if not self.unfinished:
+                    self.idle.notify_all()
+            for favorite in favorites:
+                self._job_finished(favorite, error)
+
+    def _job_finished(self, favorite: Favorite, error: Exception = None):
+        with self.lock:
+            favorite.pending -= 1
+            favorite.error = favorite.error or error
+            if favorite.pending:
+                return
+        fav_type, item = favorite.fav_type, favorite.item
+        if favorite.error is not None:
+            # add to failures, the favorite is kept for the next run
+            with self.lock:
+                self.failure[fav_type].append(item)
+            if self.on_failure is not None:
+                self.on_failure(fav_type, item, favorite.error)
+            return
+        with self.lock:
+            self.successful[fav_type].append(item)
+        # if download is successful, queue the removal from favorites
+        if self.remove_favorites:
+            self.unfavorites.put((fav_type, item))
+
+    def _unfavorite_worker(self):
+        self.listed.wait()
+        done = False
+        while not done:
+            # block for the next item, then collect more until the batch is
+            # full, the linger window is over or the pipeline closes
+            batch = [self.unfavorites.get()]
+            deadline = time.monotonic() + self.batch_linger
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                timeout = deadline - time.monotonic()
+                try:
+                    if timeout > 0:
+                        batch.append(self.unfavorites.get(timeout=timeout))
+                    else:
+                        batch.append(self.unfavorites.get_nowait())
+                except queue.Empty:
+                    break
+            by_type = dict()
+            for task in batch:
+                if task is None:
+                    done = True
+                    continue
+                fav_type, item = task
+                by_type.setdefault(fav_type, list()).append(item)
+            for fav_type, items in by_type.items():
+                self._unfavorite(fav_type, items)
+
+    def _unfavorite(self, fav_type, items: list):
+        for attempt in range(self.retries + 1):
+            try:
+                delete_favorites(self.pool, self.user, fav_type, items)
+                return
+            except Exception as e:
+                error = e
+            if attempt < self.retries:
+                time.sleep(2 ** attempt)
+        # the items stay in the downloads db, the next run only removes them
+        self.unfavorite_failure += items
+        print(f"An error occurred removing {len(items)} {fav_type} from favorites: {error}")
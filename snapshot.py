@@ -0,0 +1,98 @@
+import json
+import os
+import time
+from threading import Lock
+
+def load_json(path, default):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+def save_json(path, data):
+    # write to a temp file first so a crash never leaves a truncated file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+class FavoritesSnapshot:
+    '''
+    Last seen favorites of the user, persisted as JSON between runs
+
+    Every favorite is stored with the raw item returned by the API and the
+    time it was first seen. Each favorites type also keeps the time of its
+    last full listing, so that incremental listings can be trusted only for
+    so long.
+
+    Parameters
+    ----------
+    path: str
+        location of the snapshot file
+    full_sync_interval: int
+        seconds after which a full listing is done again
+    '''
+    def __init__(self, path, full_sync_interval=86400):
+        self.path = path
+        self.full_sync_interval = full_sync_interval
+        self.lock = Lock()
+        self.data = load_json(path, dict())
+
+    def _favorites(self, fav_type):
+        return self.data.setdefault(fav_type, {"synced_at": None, "items": dict()})
+
+    def is_known(self, fav_type, item_id):
+        with self.lock:
+            return str(item_id) in self._favorites(fav_type)["items"]
+
+    def count(self, fav_type):
+        with self.lock:
+            return len(self._favorites(fav_type)["items"])
+
+    def first_seen(self, fav_type, item_id):
+        '''Returns when a favorite was first listed, None for unknown ones'''
+        with self.lock:
+            return self._favorites(fav_type)["items"].get(str(item_id), dict()).get("first_seen")
+
+    def items(self, fav_type):
+        '''Returns the raw items of the favorites seen so far'''
+        with self.lock:
+            return [entry["item"] for entry in self._favorites(fav_type)["items"].values()]
+
+    def synced_at(self, fav_type):
+        '''Returns when the favorites were last listed in full, None if never'''
+        with self.lock:
+            return self._favorites(fav_type)["synced_at"]
+
+    def needs_full_sync(self, fav_type):
+        with self.lock:
+            synced_at = self._favorites(fav_type)["synced_at"]
+        return synced_at is None or time.time() - synced_at > self.full_sync_interval
+
+    def add(self, fav_type, items: list, full_sync=False):
+        '''
+        Records listed favorites
+
+        After a full listing the favorites that were not listed are dropped.
+        '''
+        now = time.time()
+        with self.lock:
+            favorites = self._favorites(fav_type)
+            previous = favorites["items"]
+            current = dict() if full_sync else dict(previous)
+            for item in items:
+                item_id = str(item["id"])
+                first_seen = previous.get(item_id, dict()).get("first_seen", now)
+                current[item_id] = {"item": item, "first_seen": first_seen}
+            favorites["items"] = current
+            if full_sync:
+                favorites["synced_at"] = now
+
+    def remove(self, fav_type, item_id):
+        with self.lock:
+            self._favorites(fav_type)["items"].pop(str(item_id), None)
+
+    def save(self):
+        with self.lock:
+            save_json(self.path, self.data)
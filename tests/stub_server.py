@@ -0,0 +1,90 @@
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+class RangeHandler(BaseHTTPRequestHandler):
+    '''
+    Serves the data of the server like a CDN, honouring Range requests
+
+    The server attributes shape the responses: latency seconds are waited
+    before every response, rate caps the bytes per second of each connection
+    (0 for unlimited), and the first drops requests have their connection
+    closed after drop_after bytes of the body. The Range and If-Range
+    headers of every request are recorded in requests.
+    '''
+    protocol_version = "HTTP/1.1"
+
+    def do_HEAD(self):
+        self._respond(send_body=False)
+
+    def do_GET(self):
+        self._respond(send_body=True)
+
+    def _respond(self, send_body):
+        server = self.server
+        data = server.data
+        ranges = self.headers.get("Range")
+        server.requests.append((ranges, self.headers.get("If-Range")))
+        if server.latency:
+            time.sleep(server.latency)
+        start, end = 0, len(data) - 1
+        if ranges:
+            first, _, last = ranges.split("=")[1].partition("-")
+            start, end = int(first), int(last) if last else end
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end + 1 - start))
+        self.send_header("ETag", server.etag)
+        self.end_headers()
+        if not send_body:
+            return
+        body = memoryview(data)[start:end + 1]
+        if server.drops:
+            server.drops -= 1
+            body = body[:server.drop_after]
+            self.close_connection = True
+        self._write(body)
+
+    def _write(self, body):
+        rate = self.server.rate
+        started_at = time.monotonic()
+        for sent in range(0, len(body), 64 * 1024):
+            self.wfile.write(body[sent:sent + 64 * 1024])
+            if rate:
+                # sleep until the connection is back under its rate
+                delay = started_at + (sent + 64 * 1024) / rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(handler=RangeHandler, **attributes):
+    '''
+    Starts a local HTTP server in a background thread and returns it
+
+    Parameters
+    ----------
+    handler: BaseHTTPRequestHandler
+        class handling the requests, RangeHandler by default
+    **attributes
+        attributes set on the server, read by the handler
+    '''
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    server.requests = list()
+    server.data = b""
+    server.etag = '"v1"'
+    server.latency = 0
+    server.rate = 0
+    server.drops = 0
+    server.drop_after = 0
+    for name, value in attributes.items():
+        setattr(server, name, value)
+    Thread(target=server.serve_forever, daemon=True).start()
+    server.url = f"http://127.0.0.1:{server.server_port}"
+    return server
@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+import unittest
+import requests
+from download import fetch_file
+from snapshot import load_json
+from tests.stub_server import serve
+
+data = bytes(range(256)) * 4096
+etag = '"v1"'
+
+class FetchFileResumeTest(unittest.TestCase):
+    def setUp(self):
+        self.server = serve(data=data, etag=etag, drop_after=300000)
+        self.url = f"{self.server.url}/track.flac"
+        self.directory = tempfile.mkdtemp()
+        self.fname = os.path.join(self.directory, "track.flac")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def ranges(self):
+        return [ranges for ranges, _ in self.server.requests]
+
+    def test_resumes_within_the_same_call(self):
+        self.server.drops = 2
+        fetch_file(requests.Session(), self.url, self.fname, retries=3)
+
+        with open(self.fname, "rb") as file:
+            self.assertEqual(file.read(), data)
+        self.assertEqual(os.listdir(self.directory), ["track.flac"])
+        ranges = self.ranges()
+        self.assertEqual(len(ranges), 3)
+        self.assertIsNone(ranges[0])
+        # every retry continues where the previous request broke
+        starts = [int(r.split("=")[1].rstrip("-")) for r in ranges[1:]]
+        self.assertTrue(0 < starts[0] <= self.server.drop_after)
+        self.assertTrue(starts[0] < starts[1] <= 2 * self.server.drop_after)
+        self.assertTrue(all(if_range == etag for _, if_range in self.server.requests[1:]))
+
+    def test_resumes_on_the_next_run(self):
+        self.server.drops = 1
+        with self.assertRaises((ConnectionError, requests.exceptions.RequestException)):
+            fetch_file(requests.Session(), self.url, self.fname, retries=0)
+
+        self.assertFalse(os.path.exists(self.fname))
+        record = load_json(f"{self.fname}.part.json", dict())
+        self.assertEqual(record["total"], len(data))
+        self.assertEqual(record["etag"], etag)
+        self.assertTrue(0 < record["offset"] <= self.server.drop_after)
+        self.assertEqual(os.path.getsize(f"{self.fname}.part"), record["offset"])
+
+        fetch_file(requests.Session(), self.url, self.fname)
+
+        with open(self.fname, "rb") as file:
+            self.assertEqual(file.read(), data)
+        self.assertEqual(os.listdir(self.directory), ["track.flac"])
+        self.assertEqual(self.server.requests[1], (f"bytes={record['offset']}-", etag))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+import logging
+import signal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Thread
+
+logger = logging.getLogger(__name__)
+
+class TriggerHandler(BaseHTTPRequestHandler):
+    '''
+    Sets the trigger event of the server on POST /trigger
+    '''
+    def do_POST(self):
+        if self.path.rstrip("/") != "/trigger":
+            self.send_error(404)
+            return
+        self.server.trigger.set()
+        body = b"Triggered\n"
+        self.send_response(202)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.info(f"{self.address_string()} {format % args}")
+
+def start_trigger_server(trigger: Event, host="127.0.0.1", port=8080):
+    '''
+    Serves the manual trigger endpoint in a background thread
+
+    Parameters
+    ----------
+    trigger: threading.Event
+        event set by every request to POST /trigger
+    host: str
+        address the endpoint listens on
+    port: int
+        port the endpoint listens on
+    '''
+    server = ThreadingHTTPServer((host, port), TriggerHandler)
+    server.daemon_threads = True
+    server.trigger = trigger
+    Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Listening for triggers on http://{host}:{server.server_port}/trigger")
+    return server
+
+def install_signal_trigger(trigger: Event, signum=signal.SIGUSR1):
+    '''Sets the trigger event when the process receives signum'''
+    signal.signal(signum, lambda signum, frame: trigger.set())